@@ -10,6 +10,7 @@
 #######                 1) Dump  --->  .DMP                               #######
 #######                 2) TIF   --->  .tif                               #######
 #######                 3) JPEG  --->  .jpg                               #######
+#######                 4) NPY   --->  .npy ( read as memory-map )        #######
 #######  Available conversions:                                           #######
 #######                 1) DMP   --->  tif                                #######
 #######                 2) tif   --->  DMP                                #######
@@ -24,6 +25,7 @@
 
 
 ####  PYTHON PACKAGES
+from io import BytesIO
 import numpy as np
 import scipy
 from scipy import misc as misc
@@ -46,6 +48,7 @@ ext_tif = [ 'tif' , 'tiff' , 'TIF' , 'TIFF' ]
 ext_jpg = [ 'jpg' , 'jpeg' , 'JPG' , 'JPEG' ]
 ext_png = [ 'png' , 'PNG' ]
 ext_raw = [ 'raw' , '.RAW' ]
+ext_npy = [ 'npy' , 'NPY' ]
 
 
 
@@ -175,6 +178,9 @@ def readImage( *args ):
     elif obj.extension in ext_raw:
         return readImageRaw( obj )
 
+    elif obj.extension in ext_npy:
+        return readImageNpy( obj )
+
     else:
         raise Exception('\nI/O of files ' + obj.extension + ' not supported yet!\n')
 
@@ -205,6 +211,9 @@ def writeImage( *args ):
     elif obj.extension in ext_raw:
         writeImageRaw( obj )
 
+    elif obj.extension in ext_npy:
+        writeImageNpy( obj )
+
     else:
         raise Exception('\nI/O of files ' + obj.extension + ' not supported yet!\n')   
 
@@ -294,6 +303,23 @@ def writeImageJpeg( obj ):
     image.save( fileName , quality=q )
 
 
+##  JPEG IMAGE ENCODER
+##  The array is normalized as in the writer and encoded in memory;
+##  the bytes of the JPEG stream are returned, no file is written;
+##  a flat array is encoded as a zero image
+
+def encodeImageJpeg( imarray , quality ):
+    vmin = imarray.min();  vmax = imarray.max()
+    if vmax == vmin:
+        visual = np.zeros( imarray.shape )
+    else:
+        visual = ( imarray - vmin ) / ( vmax - vmin )
+    image = Image.fromarray( ( visual * 255 ).astype( np.uint8 ) )
+    stream = BytesIO()
+    image.save( stream , format='JPEG' , quality=int( quality ) )
+    return stream.getvalue()
+
+
 
 
 #################################################
@@ -316,6 +342,16 @@ def writeImagePng( obj ):
     misc.imsave( fileName , imageAs2DArray )  
 
 
+##  PNG IMAGE ENCODER
+##  The array is encoded in memory as it is, e.g. as 8 bit image,
+##  and the bytes of the PNG stream are returned
+
+def encodeImagePng( imarray ):
+    stream = BytesIO()
+    Image.fromarray( imarray ).save( stream , format='PNG' )
+    return stream.getvalue()
+
+
 
 
 #################################################
@@ -340,6 +376,28 @@ def writeImageRaw( obj ):
     fp.write( obj.imarray )
     fp.close()
 
+
+
+
+#################################################
+#############                       #############
+#############   NPY I/O FUNCTIONS   #############
+#############                       #############
+#################################################
+##
+##  NPY IMAGE READER
+##  The array is memory-mapped, so that stacks and volumes larger
+##  than the memory can be read slice by slice
+
+def readImageNpy( obj ):
+    return np.load( obj.filename , mmap_mode='r' )
+
+
+##  NPY IMAGE WRITER
+
+def writeImageNpy( obj ):
+    np.save( obj.filename , obj.imarray )
+
     
 
 
@@ -20,6 +20,7 @@
 ######                  10) linear_regression                            ######
 ######                  11) crop_image                                   ######
 ######                  12) image_registration                           ######
+######                  13) joint_histogram                              ######
 ######                                                                   ######
 ######        Author: Filippo Arcadu, arcusfil@gmail.com, 09/07/2013     ######
 ######                                                                   ######
@@ -33,6 +34,7 @@
 ####  PYTHON LIBRARIES
 from __future__ import division,print_function
 import sys
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from numpy.fft import *
 import math
@@ -575,3 +577,48 @@ def image_registration( imreg , imtempl , method ):
     imreg_correct = align_image( imreg , vector[0] )
 
     return imreg_correct
+
+
+
+
+#######################################################################
+#######################################################################
+####                                                               ####
+####             JOINT HISTOGRAM OF 2 QUANTIZED IMAGES             ####
+####                                                               ####
+#######################################################################
+#######################################################################
+##
+##  The pixels are split in blocks of rows and each worker thread
+##  builds the partial histogram of its block with a single bincount
+##  of imq1 * nbins + imq2; the partials are reduced by summation.
+##  Output: array ( nbins , nbins ) of int64 counts
+
+def joint_histogram_block( task ):
+    imq1 , imq2 , nbins = task
+    index = imq1.reshape( -1 ).astype( np.int64 ) * nbins + imq2.reshape( -1 )
+    return np.bincount( index , minlength=nbins * nbins )
+
+
+
+def joint_histogram( imq1 , imq2 , nbins , nthreads=1 ):
+    if imq1.shape != imq2.shape:
+        sys.exit('\nERROR: The input images have different shapes!\n')
+
+    if nthreads > 1 and imq1.ndim > 0 and imq1.shape[0] >= nthreads:
+        bounds = np.linspace( 0 , imq1.shape[0] , nthreads + 1 ).astype( int )
+        tasks = [ ( imq1[bounds[i]:bounds[i+1]] , imq2[bounds[i]:bounds[i+1]] , nbins )
+                  for i in range( nthreads ) ]
+
+        pool = ThreadPool( nthreads )
+        partials = pool.map( joint_histogram_block , tasks )
+        pool.close()
+        pool.join()
+
+        J = partials[0]
+        for partial in partials[1:]:
+            J += partial
+    else:
+        J = joint_histogram_block( ( imq1 , imq2 , nbins ) )
+
+    return J.reshape( nbins , nbins )
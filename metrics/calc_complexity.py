@@ -17,9 +17,23 @@ from __future__ import division, print_function
 import argparse
 import sys
 import os
+import zlib
+import bz2
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import scipy
 from scipy import ndimage
+import tifffile
+
+
+
+
+##  OPTIONAL MODULES: lzma is not available in python 2
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 
 
@@ -38,6 +52,18 @@ myfloat = np.float32
 
 
 
+##  LOSSLESS CODECS FOR THE COMPRESSIBILITY OF THE IMAGE
+lossless_codecs = [ 'zlib' , 'bz2' , 'lzma' , 'png' ]
+
+
+
+
+##  NUMBER OF SLICES PROCESSED AT ONCE IN STACK MODE
+stack_chunk = 16
+
+
+
+
 #######################################################################
 #######################################################################
 ####                                                               ####
@@ -53,12 +79,29 @@ def getArgs():
                   help='Path to the folder containing the image to analyze')
     
     parser.add_argument('-i','--filein', dest='filein',
-                  help='Select the image to analyze')
+                  help='Select the image to analyze; in stack mode, several'
+                  +' volumes can be separated by ":"')
     
     parser.add_argument('-j','--jpeg_compr', dest='jpeg_compr', type=np.int32 , default=75,
                   help='Select the quality of the jpeg compression, ranging from'
                   +' 0 to 100 ( default: 75 )')
     
+    parser.add_argument('-b','--block', dest='block', type=int ,
+                  help='Compute SI statistics and GSI on square tiles of the selected'
+                  +' size and write maps and table of the tiles; e.g. -b 32')
+
+    parser.add_argument('-z','--tile_codec', dest='tile_codec',
+                  help='Add the compressibility of each tile with the selected'
+                  +' lossless codec: ' + ' , '.join( lossless_codecs ) )
+
+    parser.add_argument('-s','--stack', dest='stack', action='store_true' ,
+                  help='Analyze every slice of a stack or volume ( memory-mapped .npy'
+                  +' or multi-page tif ) and write one table per volume')
+
+    parser.add_argument('-n','--nproc', dest='nproc', type=int , default=4 ,
+                  help='Number of workers for the compression of the tiles'
+                  +' and of the slices in stack mode')
+
     parser.add_argument('-p','--plot', dest='plot', action='store_true' ,
                   help='Display check plots')   
 
@@ -68,6 +111,20 @@ def getArgs():
         parser.print_help()
         sys.exit('\nERROR: input image not specified!\n')
 
+    if args.stack is True and args.block is not None:
+        parser.print_help()
+        sys.exit('\nERROR: block-wise complexity not available in stack mode!\n')
+
+    if args.tile_codec is not None:
+        if args.block is None:
+            parser.print_help()
+            sys.exit('\nERROR: tile compressibility requires the block size!\n')
+
+        if args.tile_codec not in lossless_codecs or \
+           ( args.tile_codec == 'lzma' and lzma is None ):
+            parser.print_help()
+            sys.exit('\nERROR: codec ' + args.tile_codec + ' not available!\n')
+
     return args
 
 
@@ -81,32 +138,75 @@ def getArgs():
 #######################################################################
 ####################################################################### 
 
-def complexity_jpeg( image , args ):
-    print('\n1) Calculate image complexity index based on JPEG compression ....')
+##  Image quantized to 8 bits with the normalization of the JPEG writer;
+##  a flat image, e.g. a blank slice of a stack, gives a zero image
+
+def quantize_uint8( image ):
+    vmin = image.min();  vmax = image.max()
+    if vmax == vmin:
+        return np.zeros( image.shape , dtype=np.uint8 )
+    visual = ( image - vmin ) / ( vmax - vmin )
+    return ( visual * 255 ).astype( np.uint8 )
+
+
+
+##  Size in bytes of the image encoded in memory with "codec";
+##  all these encoders release the GIL while compressing
+
+def encoded_size( task ):
+    codec , image , quality = task
+
+    if codec == 'jpeg':
+        return len( io.encodeImageJpeg( image , quality ) )
+    elif codec == 'zlib':
+        return len( zlib.compress( image.tobytes() , 9 ) )
+    elif codec == 'bz2':
+        return len( bz2.compress( image.tobytes() , 9 ) )
+    elif codec == 'lzma':
+        return len( lzma.compress( image.tobytes() ) )
+    elif codec == 'png':
+        return len( io.encodeImagePng( image ) )
+
+
+
+
+#######################################################################
+#######################################################################
+####                                                               ####
+####    IMAGE COMPLEXITY INDICES BASED ON SEVERAL COMPRESSIONS     ####
+####                                                               ####
+#######################################################################
+#######################################################################
+
+##  JPEG ratio and lossless compressibility of the image quantized to
+##  8 bits ( compressed size / number of pixels ) for each codec; all
+##  the encodings run in parallel threads, so that the whole record
+##  costs about the time of the slowest codec
+
+def complexity_compression( image , args ):
+    print('\n1) Calculate image complexity indices based on compression ....')
 
-    ##  Save converted file to temporary file
-    compr_ratio   = 100     
-    tmp_file_orig = args.pathin + 'tmp_gray.jpg'
-    io.writeImage( tmp_file_orig , image , compr_ratio )
+    codecs = available_codecs()
+    image8 = quantize_uint8( image )
 
-    ##  JPEG compression
-    compr_ratio    = 75  
-    tmp_file_compr = args.pathin + 'tmp_comprss' + str( compr_ratio ) + '.jpg'
-    io.writeImage( tmp_file_compr , image , compr_ratio )
+    tasks = [ ( 'jpeg' , image , 100 ) , ( 'jpeg' , image , args.jpeg_compr ) ]
+    tasks += [ ( codec , image8 , None ) for codec in codecs ]
 
-    ##  Evaluate ratio of the file sizes
-    size_orig  = myfloat( os.stat( tmp_file_orig ).st_size )
-    size_compr = myfloat( os.stat( tmp_file_compr ).st_size )
+    pool = ThreadPool( len( tasks ) )
+    sizes = pool.map( encoded_size , tasks )
+    pool.close()
+    pool.join()
 
-    complexity = size_compr / size_orig 
+    ##  One record with all the ratios
+    record = { 'jpeg' : myfloat( sizes[1] ) / myfloat( sizes[0] ) }
+    for codec , size in zip( codecs , sizes[2:] ):
+        record[codec] = myfloat( size ) / myfloat( image8.size )
 
-    print('Original file size: ', size_orig)
-    print('Compressed file size: ', size_compr)
-    print('JPEG compression factor: ', complexity)
+    print('JPEG compression factor ( quality ', args.jpeg_compr, ' ): ', record['jpeg'])
+    for codec in codecs:
+        print(codec, ' compression ratio: ', record[codec])
 
-    ##  Close compressed image and delete temporary compressed file
-    os.remove( tmp_file_orig )
-    os.remove( tmp_file_compr ) 
+    return record
 
 
 
@@ -119,18 +219,23 @@ def complexity_jpeg( image , args ):
 #######################################################################
 #######################################################################  
 
+##  Map of the spatial information (SI) or, in other words, the map
+##  of magnitudes of the edge images of vertical and horizontal Sobel
+
+def spatial_information_map( image ):
+    dy = ndimage.filters.sobel( image , 1 )
+    dx = ndimage.filters.sobel( image , 0 ) 
+    return dx*dx + dy*dy
+
+
+
 def complexity_struct_info( image ):
     print('\n2) Calculate image complexity index based on spatial information ....')  
     
     ##  Applying vertical and horizontal Sobel filter
     print('Applying vertical and horizontal Sobel filter')    
-    dy = ndimage.filters.sobel( image , 1 )
-    dx = ndimage.filters.sobel( image , 0 ) 
-
-    ##  Calculate the map of the spatial information (SI) or,
-    ##  in other words, the map of magnitudes of the edge images
     npix   = image.shape[0] * image.shape[1] 
-    map_si =  dx*dx + dy*dy
+    map_si = spatial_information_map( image )
 
     si_mean = np.mean( map_si )
     si_rms  = np.sqrt( 1.0/npix * np.sum( map_si * map_si )  )
@@ -151,6 +256,193 @@ def complexity_struct_info( image ):
 
 
 
+#######################################################################
+#######################################################################
+####                                                               ####
+####                  BLOCK-WISE COMPLEXITY MAP                    ####
+####                                                               ####
+#######################################################################
+#######################################################################
+
+##  View of the image as array of tiles ( nbx , nby , block , block );
+##  the rows and columns exceeding a multiple of "block" are neglected
+
+def block_view( image , block ):
+    nbx = image.shape[0] // block;  nby = image.shape[1] // block
+    tiles = image[:nbx*block,:nby*block].reshape( nbx , block , nby , block )
+    return tiles.swapaxes( 1 , 2 )
+
+
+
+##  SI mean , rms , std and GSI of every tile in one vectorized pass
+##  over the SI map of the whole image.
+##  Output: array ( 4 , nbx , nby )
+
+def complexity_blocks( image , block ):
+    tiles = block_view( spatial_information_map( image ) , block )
+
+    si_mean = np.mean( tiles , axis=( 2 , 3 ) )
+    si_rms  = np.sqrt( np.mean( tiles * tiles , axis=( 2 , 3 ) ) )
+    si_std  = np.std( tiles , axis=( 2 , 3 ) )
+    gsi     = np.count_nonzero( tiles , axis=( 2 , 3 ) ) / myfloat( block * block )
+
+    return np.array( [ si_mean , si_rms , si_std , gsi ] , dtype=myfloat )
+
+
+
+##  Compressibility of every tile of the image quantized to 8 bits,
+##  the tiles being encoded by a pool of worker threads.
+##  Output: array ( nbx , nby )
+
+def compression_blocks( image , block , codec , nproc=4 ):
+    tiles = block_view( quantize_uint8( image ) , block )
+    nbx , nby = tiles.shape[:2]
+    tasks = [ ( codec , np.ascontiguousarray( tiles[i,j] ) , None )
+              for i in range( nbx ) for j in range( nby ) ]
+
+    pool = ThreadPool( nproc )
+    sizes = pool.map( encoded_size , tasks )
+    pool.close()
+    pool.join()
+
+    return np.array( sizes , dtype=myfloat ).reshape( nbx , nby ) / myfloat( block * block )
+
+
+
+##  Maps of the tiles written as images and table with one row per tile
+
+def write_complexity_blocks( image , filein , args ):
+    print('\n4) Calculate block-wise complexity on tiles ', args.block, ' X ', args.block, ' ....')
+
+    maps = complexity_blocks( image , args.block )
+    names = [ 'si_mean' , 'si_rms' , 'si_std' , 'gsi' ]
+
+    if args.tile_codec is not None:
+        ratios = compression_blocks( image , args.block , args.tile_codec , args.nproc )
+        maps = np.concatenate( ( maps , ratios[None,:,:] ) , axis=0 )
+        names.append( args.tile_codec )
+
+    ##  The table is written first, so that it survives a failure of
+    ##  the image writer
+    base = filein[:len(filein)-4]
+    nbx , nby = maps.shape[1:]
+    rows , cols = np.meshgrid( np.arange( nbx ) , np.arange( nby ) , indexing='ij' )
+    table = np.column_stack( [ rows.reshape( -1 ) * args.block , cols.reshape( -1 ) * args.block ]
+                             + [ m.reshape( -1 ) for m in maps ] )
+    fileout = base + '_complexity_tiles.txt'
+    np.savetxt( fileout , table , fmt='%.8g' , header='row col ' + ' '.join( names ) )
+
+    ##  The maps are written as grey-scale images explicitly, otherwise
+    ##  a map with 3 or 4 columns of tiles would be taken as RGB
+    for name , m in zip( names , maps ):
+        tifffile.imwrite( base + '_' + name + '_map.tif' , m , photometric='minisblack' )
+
+    print('Number of tiles: ', nbx, '  X  ', nby)
+    print('Written maps ', base + '_<index>_map.tif', ' and table:\n', fileout)
+
+    return maps
+
+
+
+
+#######################################################################
+#######################################################################
+####                                                               ####
+####              COMPLEXITY OF STACKS AND VOLUMES                 ####
+####                                                               ####
+#######################################################################
+#######################################################################
+
+##  Available lossless codecs
+
+def available_codecs():
+    return [ codec for codec in lossless_codecs
+             if codec != 'lzma' or lzma is not None ]
+
+
+
+##  JPEG ratio and lossless ratios of one slice, encoded one after the
+##  other by a worker process of the persistent pool
+
+def compression_ratios( task ):
+    image , quality = task
+
+    codecs = available_codecs()
+    image8 = quantize_uint8( image )
+
+    ratios = [ myfloat( encoded_size( ( 'jpeg' , image , quality ) ) ) /
+               myfloat( encoded_size( ( 'jpeg' , image , 100 ) ) ) ]
+    for codec in codecs:
+        ratios.append( myfloat( encoded_size( ( codec , image8 , None ) ) ) / myfloat( image8.size ) )
+
+    return ratios
+
+
+
+##  SI mean , rms , std and GSI of each slice of a chunk ( nslices , nx , ny ):
+##  the 2D Sobel filters of all the slices are applied at once with 1D
+##  correlations along the two axes of the slices, as the 3D Sobel of
+##  ndimage would also smooth across the slices.
+##  Output: array ( nslices , 4 )
+
+def complexity_struct_info_stack( chunk ):
+    chunk = chunk.astype( myfloat )
+    deriv = [ -1 , 0 , 1 ];  smooth = [ 1 , 2 , 1 ]
+
+    dx = ndimage.correlate1d( ndimage.correlate1d( chunk , deriv , axis=1 ) , smooth , axis=2 )
+    dy = ndimage.correlate1d( ndimage.correlate1d( chunk , deriv , axis=2 ) , smooth , axis=1 )
+    map_si = dx*dx + dy*dy
+
+    npix    = chunk.shape[1] * chunk.shape[2]
+    si_mean = np.mean( map_si , axis=( 1 , 2 ) )
+    si_rms  = np.sqrt( np.mean( map_si * map_si , axis=( 1 , 2 ) ) )
+    si_std  = np.std( map_si , axis=( 1 , 2 ) )
+    gsi     = np.count_nonzero( map_si , axis=( 1 , 2 ) ) / myfloat( npix )
+
+    return np.column_stack( ( si_mean , si_rms , si_std , gsi ) )
+
+
+
+##  Complexity of all the slices of a volume, read a chunk of slices at
+##  a time: the compression ratios of a chunk are dispatched to the pool
+##  while the SI of the same chunk is computed.
+##  Output: array ( nslices , 1 + ncodecs + 4 ), one row per slice
+
+def complexity_stack( volume , quality , pool ):
+    results = []
+
+    for i in range( 0 , volume.shape[0] , stack_chunk ):
+        chunk = np.asarray( volume[i:i+stack_chunk] )
+        ratios = pool.map_async( compression_ratios , [ ( image , quality ) for image in chunk ] )
+        si = complexity_struct_info_stack( chunk )
+        results.append( np.column_stack( ( np.array( ratios.get() ) , si ) ) )
+
+    return np.concatenate( results , axis=0 )
+
+
+
+def write_complexity_stack( filein , args , pool ):
+    volume = io.readImage( filein )
+
+    print('\nReading input volume:\n', filein)
+    print('Volume size: ', volume.shape)
+
+    if volume.ndim != 3:
+        print('\nWarning: ', filein, ' is not a stack of images, skipped')
+        return
+
+    table = complexity_stack( volume , args.jpeg_compr , pool )
+    table = np.column_stack( ( np.arange( volume.shape[0] ) , table ) )
+
+    names = [ 'slice' , 'jpeg' ] + available_codecs() + [ 'si_mean' , 'si_rms' , 'si_std' , 'gsi' ]
+    fileout = filein[:len(filein)-4] + '_complexity_slices.txt'
+    np.savetxt( fileout , table , fmt='%.8g' , header=' '.join( names ) )
+
+    print('Written table:\n', fileout)
+
+
+
+
 #######################################################################
 #######################################################################
 ####                                                               ####
@@ -174,6 +466,23 @@ def main():
     ##  Get input arguments
     args = getArgs()
 
+    if args.jpeg_compr <= 0 or args.jpeg_compr > 100:
+        print('\nWarning: JPEG quality out of range, using 75')
+        args.jpeg_compr = 75    
+
+
+    ##  Stack mode: one table per volume, with the same pool of
+    ##  workers for all the volumes
+    if args.stack is True:
+        pool = mp.Pool( args.nproc )
+
+        for filein in args.filein.split(':'):
+            write_complexity_stack( args.pathin + filein , args , pool )
+
+        pool.close()
+        pool.join()
+        return
+
 
     ##  Read input image
     filein  = args.pathin + args.filein 
@@ -182,22 +491,24 @@ def main():
     
     print('\nReading input image:\n', filein)     
     print('Image size: ', nx, '  X  ', ny)
-    
-    if args.jpeg_compr <= 0 and args.jpeg_compr >= 100:
-        args.jpeg_compr = 75    
 
     if args.plot is True:
         dis.plot( image , 'Input image' )
 
 
-    ##  Calculate image complexity index based on JPEG compression
-    complexity_jpeg( image , args )
+    ##  Calculate image complexity indices based on JPEG and lossless compression
+    complexity_compression( image , args )
 
 
     ##  Calculate image complexity index based on spatial information (SI)
     complexity_struct_info( image )
 
 
+    ##  Calculate block-wise complexity map, if enabled
+    if args.block is not None:
+        write_complexity_blocks( image , filein , args )
+
+
 
 
 #######################################################################
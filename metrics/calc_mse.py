@@ -26,7 +26,7 @@ import os
 import glob
 import datetime
 import numpy as np
-import math
+import multiprocessing as mp
 
 
 
@@ -46,6 +46,14 @@ myfloat = np.float64
 
 
 
+####  CONSTANTS
+##  Number of pixels processed at each pass of the fused kernel:
+##  small enough to keep the chunks of both images in cache
+chunk_size = 2**16
+
+
+
+
 ###########################################################
 ###########################################################
 ####                                                   ####
@@ -68,6 +76,11 @@ def getArgs():
     
     parser.add_argument('-D','--path',dest='path',
                         help = 'Select a path to a bunch of images to analyze')
+
+    parser.add_argument('-k','--stack',dest='stack',
+                        help = 'Select a stack of images to analyze, e.g. the'
+                        + ' iterates of a reconstruction, stored as a single'
+                        + ' ( N , nx , ny ) file; .npy stacks are memory-mapped')
     
     parser.add_argument('-s','--scaling',dest='scaling',action='store_true',
                         help = 'Enable scaling procedure to fit the interval'
@@ -89,6 +102,23 @@ def getArgs():
     parser.add_argument('-g','--grad',dest='gradient', action='store_true',
                         help = 'Run the analysis on the gradient images of the inputs')    
 
+    parser.add_argument('-a','--axis',dest='axis',type=int,
+                        help = 'Analyze the 3D volumes slice by slice along the'
+                        + ' selected axis; per-slice and global values are written'
+                        + ' in a table; e.g. -a 0')
+
+    parser.add_argument('-o','--table',dest='table',
+                        help = 'Select the output table of the slice by slice'
+                        + ' analysis: .csv or .npy ( default: <image2>_slices.csv )')
+
+    parser.add_argument('-q','--quantiles',dest='quantiles',action='store_true',
+                        help = 'Compute the quantiles p50, p95, p99 of the absolute'
+                        + ' error and write its histogram')
+
+    parser.add_argument('-m','--local_map',dest='local_map',type=int,
+                        help = 'Write the maps of local RMSE, PSNR and MAE computed'
+                        + ' on a square window of the selected size; e.g. -m 15')
+
     parser.add_argument('-p','--plot',dest='plot',action='store_true',
                         help='Enable plots to check whether the orientation'
                         +' of the images is correct')
@@ -105,11 +135,24 @@ def getArgs():
         parser.print_help()
         sys.exit('\nERROR: Reference image not specified!\n')
     
-    if args.image2 is None and args.path is None:
+    if args.image2 is None and args.path is None and args.stack is None:
         parser.print_help()
         sys.exit('\nERROR: Neither single image nor bunch of images'
-                 + ' to analyze specified!\n')     
-    
+                 + ' to analyze specified!\n')
+
+    ##  The stack is compared with the oracle as it is, in one pass
+    if args.stack is not None:
+        if args.scaling is True or args.register is True or args.resol_circle is True \
+           or args.roi is not None or args.gradient is True:
+            parser.print_help()
+            sys.exit('\nERROR: Options -s, -t, -c, -r and -g are not available'
+                     + ' for a stack of images!\n')
+
+        if args.axis is not None or args.quantiles is True or args.local_map is not None:
+            parser.print_help()
+            sys.exit('\nERROR: Options -a, -q and -m are not available'
+                     + ' for a stack of images!\n')
+
     return args
 
 
@@ -118,23 +161,31 @@ def getArgs():
 ###########################################################
 ###########################################################
 ####                                                   ####
-####        DECOMPOSE INTEGER NUMBER IN FACTORS        ####                 
+####          MASK OF THE PIXELS OF A ROI FILE         ####
 ####                                                   ####
 ###########################################################
 ###########################################################
 
-def factors( n ):
-    result = []
-    for i in range(2,n+1): 
-        s = 0;
-        while n/i == math.floor(n/float(i)): 
-            n = n/float(i)
-            s += 1
-        if s > 0:
-            for k in range(s):
-                result.append(i) 
-            if n == 1:
-                return result
+##  The text file with the pixel list generated by the Fiji plugin
+##  "Get Roi Pixels" is parsed only once: the pixels are stored as
+##  a bit-packed boolean mask, keyed by path, modification time of
+##  the file and shape of the image
+
+roi_cache = {}
+
+def load_roi_mask( filename , shape ):
+    key = ( os.path.abspath( filename ) , os.path.getmtime( filename ) , tuple( shape ) )
+
+    if key not in roi_cache:
+        pixels = np.loadtxt( filename , ndmin=2 ).astype( int )
+        mask = np.zeros( shape , dtype=bool )
+        mask[pixels[:,0],pixels[:,1]] = True
+        roi_cache[key] = np.packbits( mask )
+
+    npix = int( np.prod( shape ) )
+    mask = np.unpackbits( roi_cache[key] )[:npix].reshape( shape )
+
+    return mask.astype( bool )
 
 
 
@@ -168,6 +219,9 @@ def compute_gradient_image( image ):
 ##  r(x,y)  --->  reference image
 ##  t(x,y)  --->  test image
 ##  nx , ny --->  number of rown and columns
+##
+##  The single figures of merit are taken from the fused pass
+##  of "figures_of_merit" below
 
 
 ##  SNR ---> SIGNAL TO NOISE RATIO
@@ -176,10 +230,7 @@ def compute_gradient_image( image ):
 ##                sum_{x}sum_{y} [ r(x,y) - t(x,y) ]^2 )    
 
 def calc_snr( oracle , image ):
-    num = np.sum( oracle * oracle )
-    den = np.sum( ( oracle - image ) * ( oracle - image ) )
-    SNR = 10 * np.log10( num / den )
-    return SNR
+    return ErrorStats().update( oracle , image ).metrics()[0]
 
 
 
@@ -189,12 +240,7 @@ def calc_snr( oracle , image ):
 ##  ( 1/( nx * ny ) * sum_{x}sum_{y} [ r(x,y) - t(x,y) ]^2 )   
 
 def calc_psnr( oracle , image ):
-    nx , ny = image.shape
-    factor = 1.0 / ( nx * ny )
-    num = ( np.max( oracle ) )**2
-    den = factor * np.sum( ( oracle - image ) * ( oracle - image ) )
-    PSNR = 10 * np.log10( num / den )
-    return PSNR
+    return ErrorStats().update( oracle , image ).metrics()[1]
 
 
 
@@ -203,10 +249,7 @@ def calc_psnr( oracle , image ):
 ##  RMSE = 1/( nx * ny ) * sum_{x}sum_{y} [ r(x,y) - t(x,y) ]^2 
 
 def calc_rmse( oracle , image ):
-    nx , ny = image.shape 
-    RMSE = np.sqrt( 1.0/myfloat( nx * ny ) * \
-           np.sum( ( oracle - image ) * ( oracle - image ) ) )
-    return RMSE
+    return ErrorStats().update( oracle , image ).metrics()[2]
 
 
 
@@ -215,10 +258,599 @@ def calc_rmse( oracle , image ):
 ##  MAE = 1/( nx * ny ) * sum_{x}sum_{y} | r(x,y) - t(x,y) |      
 
 def calc_mae( oracle , image ):
-    nx , ny = image.shape 
-    MAE = 1.0/myfloat( nx * ny ) * \
-          np.sum( np.abs( oracle - image ) ) 
-    return MAE
+    return ErrorStats().update( oracle , image ).metrics()[3]
+
+
+
+
+##  NATIVE INTEGER DOMAIN
+##
+##  uint8 , int8 , uint16 and int16 images are not converted to
+##  floating point: the squared and absolute differences are
+##  accumulated exactly in wide integers, chunk by chunk
+
+def is_integer_image( image ):
+    return np.issubdtype( image.dtype , np.integer ) and image.dtype.itemsize <= 2
+
+
+
+def integer_domain( oracle , image ):
+    return is_integer_image( oracle ) and is_integer_image( image )
+
+
+
+##  Cast of the input images: integer images are kept in their
+##  native type, unless the gradient images are required
+
+def cast_image( image , args ):
+    if is_integer_image( image ) is True and args.gradient is False:
+        return image
+    return image.astype( myfloat )
+
+
+
+##  FUSED SINGLE-PASS COMPUTATION OF ALL FIGURES OF MERIT
+##
+##  Oracle and test image are walked once, in chunks of "chunk_size"
+##  pixels, accumulating:
+##      sum_{x,y} r^2 , sum_{x,y} ( r - t )^2 , sum_{x,y} | r - t | ,
+##      max | r - t | , max( r )
+##  from which SNR, PSNR, RMSE, MAE and the maximum absolute error
+##  are obtained together
+
+def figures_of_merit( npix , sum_r2 , sum_d2 , sum_ad , max_ad , max_r ):
+    ##  Exact integer sums are converted to floating point only here
+    sum_r2 = np.asarray( sum_r2 , dtype=myfloat )
+    sum_d2 = np.asarray( sum_d2 , dtype=myfloat )
+    sum_ad = np.asarray( sum_ad , dtype=myfloat )
+    max_r = myfloat( max_r )
+
+    SNR = 10 * np.log10( sum_r2 / sum_d2 )
+    PSNR = 10 * np.log10( max_r * max_r / ( sum_d2 / myfloat( npix ) ) )
+    RMSE = np.sqrt( sum_d2 / myfloat( npix ) )
+    MAE = sum_ad / myfloat( npix )
+    return SNR , PSNR , RMSE , MAE , max_ad
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####       MERGEABLE ACCUMULATOR OF ERROR STATISTICS   ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Usage:
+##      stats = ErrorStats()
+##      for r , t in chunks:    # slices, tiles, memmap windows
+##          stats.update( r , t )
+##      SNR , PSNR , RMSE , MAE , MAXERR = stats.metrics()
+##
+##  With "quantiles=True" the absolute errors of each chunk are also
+##  added to an "ErrorSketch" within the same pass.
+##
+##  The accumulator stores only the sums and maxima used by
+##  "figures_of_merit", therefore the partial accumulators of
+##  disjoint chunks, e.g. computed by different worker processes,
+##  are combined with "merge" and give the same result of the
+##  computation on the full arrays ( up to the rounding of the
+##  floating point sums )
+
+class ErrorStats:
+    def __init__ ( self , quantiles=False ):
+        ##  Number of pixels accumulated so far
+        self.npix = 0
+
+        ##  sum r^2 , sum ( r - t )^2 , sum | r - t | ; they stay
+        ##  python integers as long as only integer chunks are added
+        self.sum_r2 = 0
+        self.sum_d2 = 0
+        self.sum_ad = 0
+
+        ##  max | r - t | , max( r )
+        self.max_ad = 0
+        self.max_r = -np.inf
+
+        ##  Sketch of the distribution of | r - t | , if enabled
+        if quantiles is True:
+            self.sketch = ErrorSketch()
+        else:
+            self.sketch = None
+
+
+    ##  ADD A CHUNK OF ORACLE AND TEST IMAGE
+    def update( self , oracle , image ):
+        if oracle.shape != image.shape:
+            sys.exit('\nERROR: The input chunks have different shapes!\n')
+
+        if oracle.size == 0:
+            return self
+
+        ##  Collapse all dimensions but the first one, so that cropped
+        ##  views and memmaps are walked without being copied
+        oracle = oracle.reshape( oracle.shape[0] , -1 )
+        image = image.reshape( image.shape[0] , -1 )
+        nrows , ncols = oracle.shape
+        nstep = max( 1 , chunk_size // ncols )
+
+        ##  Images of integers up to 16 bits are accumulated exactly:
+        ##  each chunk in int64, the totals as python integers
+        if integer_domain( oracle , image ) is True:
+            wtype = np.int64;  total = int
+        else:
+            wtype = myfloat;  total = float
+
+        for i in range( 0 , nrows , nstep ):
+            r = oracle[i:i+nstep,:].astype( wtype ).reshape( -1 )
+            d = r - image[i:i+nstep,:].reshape( -1 )
+            self.sum_r2 += total( np.dot( r , r ) )
+            self.sum_d2 += total( np.dot( d , d ) )
+            np.abs( d , out=d )
+            self.sum_ad += total( np.sum( d ) )
+            if self.sketch is not None:
+                self.sketch.update( d )
+            self.max_ad = max( self.max_ad , total( np.max( d ) ) )
+            self.max_r = max( self.max_r , total( np.max( r ) ) )
+
+        self.npix += nrows * ncols
+
+        return self
+
+
+    ##  COMBINE WITH THE ACCUMULATOR OF AN OTHER SET OF CHUNKS
+    def merge( self , other ):
+        self.npix += other.npix
+        self.sum_r2 += other.sum_r2
+        self.sum_d2 += other.sum_d2
+        self.sum_ad += other.sum_ad
+        self.max_ad = max( self.max_ad , other.max_ad )
+        self.max_r = max( self.max_r , other.max_r )
+
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge( other.sketch )
+
+        return self
+
+
+    ##  SNR , PSNR , RMSE , MAE , MAXERR OF ALL THE CHUNKS SEEN
+    def metrics( self ):
+        return figures_of_merit( self.npix , self.sum_r2 , self.sum_d2 ,
+                                 self.sum_ad , self.max_ad , self.max_r )
+
+
+
+##  Streaming evaluation of two arrays that do not fit in memory,
+##  e.g. volumes memory-mapped from disk: slabs of "nslices" along
+##  the first axis are read one at a time
+
+def calc_metrics_stream( oracle , image , nslices=1 , quantiles=False ):
+    if oracle.shape != image.shape:
+        sys.exit('\nERROR: The input images have different shapes!\n')
+
+    stats = ErrorStats( quantiles )
+
+    for i in range( 0 , oracle.shape[0] , nslices ):
+        stats.update( oracle[i:i+nslices] , image[i:i+nslices] )
+
+    return stats
+
+
+
+##  Parallel reduction over worker processes: each worker opens
+##  its own memory-map of the two files, accumulates a slab and
+##  sends back only its ErrorStats
+
+def error_stats_slab( task ):
+    file1 , file2 , i0 , i1 , quantiles = task
+    oracle = io.readImage( file1 )
+    image = io.readImage( file2 )
+
+    return calc_metrics_stream( oracle[i0:i1] , image[i0:i1] , quantiles=quantiles )
+
+
+
+def calc_metrics_parallel( file1 , file2 , nproc=None , quantiles=False ):
+    if nproc is None:
+        nproc = mp.cpu_count()
+
+    nz = io.readImage( file1 ).shape[0]
+    bounds = np.linspace( 0 , nz , nproc + 1 ).astype( int )
+    tasks = [ ( file1 , file2 , bounds[i] , bounds[i+1] , quantiles ) for i in range( nproc ) ]
+
+    pool = mp.Pool( nproc )
+    partials = pool.map( error_stats_slab , tasks )
+    pool.close()
+    pool.join()
+
+    stats = ErrorStats( quantiles )
+    for partial in partials:
+        stats.merge( partial )
+
+    return stats
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####     MERGEABLE SKETCH OF THE ERROR DISTRIBUTION    ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Streaming quantiles of | r - t | without sorting: each value
+##  v > 0 is counted in the logarithmic bucket
+##      k = ceil( log( v ) / log( gamma ) ) ,  gamma = ( 1 + a ) / ( 1 - a )
+##  i.e. ( gamma^(k-1) , gamma^k ], and the zeros are counted apart.
+##  Any quantile is returned with a relative error smaller than the
+##  accuracy "a", the maximum is exact. The buckets do not depend on
+##  the data range, so sketches of different chunks or processes
+##  are combined exactly by adding their counts with "merge".
+##  The buckets are also the histogram of the errors.
+
+class ErrorSketch:
+    def __init__ ( self , accuracy=0.01 ):
+        ##  Relative accuracy of the quantiles
+        self.accuracy = accuracy
+        self.gamma = ( 1 + accuracy ) / ( 1 - accuracy )
+        self.log_gamma = np.log( self.gamma )
+
+        ##  Total number of values and number of zeros
+        self.count = 0
+        self.nzero = 0
+
+        ##  Sorted bucket indices and their counts
+        self.keys = np.zeros( 0 , dtype=np.int64 )
+        self.counts = np.zeros( 0 , dtype=np.int64 )
+
+        ##  Maximum value
+        self.max = 0
+
+
+    ##  ADD THE BUCKET COUNTS OF AN OTHER SKETCH OR CHUNK
+    def add_buckets( self , keys , counts ):
+        keys = np.concatenate( ( self.keys , keys ) )
+        counts = np.concatenate( ( self.counts , counts ) )
+        self.keys , ind = np.unique( keys , return_inverse=True )
+        self.counts = np.bincount( ind.reshape( -1 ) , weights=counts ).astype( np.int64 )
+
+
+    ##  ADD A CHUNK OF NON-NEGATIVE VALUES
+    def update( self , values ):
+        values = values.reshape( -1 )
+        if values.size == 0:
+            return self
+
+        positive = values[values > 0]
+        self.count += values.size
+        self.nzero += values.size - positive.size
+        self.max = max( self.max , values.max() )
+
+        if positive.size > 0:
+            keys = np.ceil( np.log( positive.astype( myfloat ) ) / self.log_gamma )
+            keys , counts = np.unique( keys.astype( np.int64 ) , return_counts=True )
+            self.add_buckets( keys , counts )
+
+        return self
+
+
+    ##  COMBINE WITH AN OTHER SKETCH WITH THE SAME ACCURACY
+    def merge( self , other ):
+        if other.accuracy != self.accuracy:
+            sys.exit('\nERROR: Sketches with different accuracy cannot be merged!\n')
+
+        self.count += other.count
+        self.nzero += other.nzero
+        self.max = max( self.max , other.max )
+        self.add_buckets( other.keys , other.counts )
+
+        return self
+
+
+    ##  QUANTILE q , WITH 0 <= q <= 1
+    def quantile( self , q ):
+        if self.count == 0:
+            return np.nan
+
+        rank = q * ( self.count - 1 )
+        if rank < self.nzero:
+            return 0.0
+
+        if q >= 1:
+            return self.max
+
+        ind = np.searchsorted( np.cumsum( self.counts ) , rank - self.nzero , side='right' )
+        ind = min( ind , len( self.keys ) - 1 )
+        value = 2 * self.gamma**self.keys[ind] / ( self.gamma + 1 )
+
+        return min( value , self.max )
+
+
+    ##  HISTOGRAM: LOWER EDGES , UPPER EDGES AND COUNTS OF THE BUCKETS;
+    ##  THE FIRST BUCKET [0,0] HOLDS THE ZEROS
+    def histogram( self ):
+        lower = np.concatenate( ( [ 0.0 ] , self.gamma**( self.keys - 1.0 ) ) )
+        upper = np.concatenate( ( [ 0.0 ] , self.gamma**self.keys.astype( myfloat ) ) )
+        counts = np.concatenate( ( [ self.nzero ] , self.counts ) )
+
+        return lower , upper , counts
+
+
+
+##  Print the quantiles of the absolute error and write the
+##  histogram next to the analyzed image
+
+def write_error_quantiles( stats , filein ):
+    sketch = stats.sketch
+    p50 = sketch.quantile( 0.50 )
+    p95 = sketch.quantile( 0.95 )
+    p99 = sketch.quantile( 0.99 )
+
+    print('\nQuantiles of the absolute error ( relative accuracy ', sketch.accuracy, ' ):')
+    print('p50 = ', p50)
+    print('p95 = ', p95)
+    print('p99 = ', p99)
+    print('max = ', sketch.max)
+
+    lower , upper , counts = sketch.histogram()
+    fileout = filein[:len(filein)-4] + '_error_histogram.txt'
+    np.savetxt( fileout , np.column_stack( ( lower , upper , counts ) ) ,
+                header='p50 = ' + str( p50 ) + '  p95 = ' + str( p95 ) +
+                       '  p99 = ' + str( p99 ) + '  max = ' + str( sketch.max ) +
+                       '\nlower_edge upper_edge count' )
+    print('Written histogram of the absolute error:\n', fileout)
+
+    return p50 , p95 , p99
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####               MAPS OF LOCAL ERRORS                ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Local RMSE , PSNR and MAE on a square window of size "window"
+##  centred on each pixel. The local sums of ( r - t )^2 and | r - t |
+##  are obtained in O(N), for any window size, with the cumulative
+##  sums of "my_image_process.local_sum". The images are processed
+##  in tiles of "tile_rows" rows, each one padded with the rows of
+##  the neighbouring tiles falling inside the window, so that large
+##  images never require full-size temporary arrays.
+##  At the borders only the pixels inside the image are averaged;
+##  the local PSNR uses the global peak of the oracle.
+
+def calc_local_error_maps( oracle , image , window , tile_rows=256 ):
+    if oracle.shape != image.shape:
+        sys.exit('\nERROR: The input images have different shapes!\n')
+
+    nrows , ncols = oracle.shape
+    hl = ( window - 1 ) // 2;  hr = window - 1 - hl
+    peak = myfloat( np.max( oracle ) )
+
+    map_rmse = np.zeros( ( nrows , ncols ) , dtype=myfloat )
+    map_psnr = np.zeros( ( nrows , ncols ) , dtype=myfloat )
+    map_mae = np.zeros( ( nrows , ncols ) , dtype=myfloat )
+
+
+    ##  Number of image pixels inside each window: the product
+    ##  of the counts along rows and columns
+    x = np.arange( nrows )
+    count_rows = np.minimum( x + hr , nrows - 1 ) - np.maximum( x - hl , 0 ) + 1
+    y = np.arange( ncols )
+    count_cols = np.minimum( y + hr , ncols - 1 ) - np.maximum( y - hl , 0 ) + 1
+
+
+    ##  Loop on the tiles
+    for i0 in range( 0 , nrows , tile_rows ):
+        i1 = min( i0 + tile_rows , nrows )
+        j0 = max( 0 , i0 - hl );  j1 = min( nrows , i1 + hr )
+
+        d = oracle[j0:j1,:].astype( myfloat ) - image[j0:j1,:]
+        k0 = i0 - j0 + hr
+        sl = ( slice( k0 , k0 + i1 - i0 ) , slice( hr , hr + ncols ) )
+        count = np.outer( count_rows[i0:i1] , count_cols ).astype( myfloat )
+
+        mse = proc.local_sum( d * d , ( window , window ) )[sl] / count
+        np.abs( d , out=d )
+        map_mae[i0:i1,:] = proc.local_sum( d , ( window , window ) )[sl] / count
+
+        ##  Round-off of the cumulative sums can give tiny negative values
+        np.clip( mse , 0 , None , out=mse )
+        map_rmse[i0:i1,:] = np.sqrt( mse )
+
+        with np.errstate( divide='ignore' ):
+            map_psnr[i0:i1,:] = 10 * np.log10( peak * peak / mse )
+
+    return map_rmse , map_psnr , map_mae
+
+
+
+##  Write the maps next to the analyzed image
+
+def write_local_error_maps( oracle , image , filein , args ):
+    if image.ndim != 2:
+        print('\nWarning: maps of local errors available only for 2D images')
+        return
+
+    print('\nComputing maps of local errors with window ', args.local_map, ' ....')
+    map_rmse , map_psnr , map_mae = calc_local_error_maps( oracle , image , args.local_map )
+
+    base = filein[:len(filein)-4]
+    io.writeImage( base + '_rmse_map.tif' , map_rmse )
+    io.writeImage( base + '_psnr_map.tif' , map_psnr )
+    io.writeImage( base + '_mae_map.tif' , map_mae )
+    print('Written maps:\n', base + '_rmse_map.tif\n', base + '_psnr_map.tif\n',
+          base + '_mae_map.tif')
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####        BATCH EVALUATION OF A STACK OF IMAGES      ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  All the N images of "stack", shape ( N , nx , ny ), are compared
+##  with the same oracle, shape ( nx , ny ), at once: the oracle is
+##  read only once, a block of rows at a time, and each block is
+##  compared with the corresponding rows of all the N images in a
+##  single vectorized pass. "stack" can be a memory-map; integer
+##  stacks up to 16 bits are accumulated exactly in int64.
+##  Output: array ( N , 4 ) with SNR , PSNR , RMSE , MAE of each image
+##  ( N , 5 ) if "maxerr" is True, with the maximum absolute error
+
+def calc_metrics_batch( oracle , stack , maxerr=False ):
+    if stack.shape[1:] != oracle.shape:
+        sys.exit('\nERROR: The images of the stack and the oracle have different shapes!\n')
+
+    nimg = stack.shape[0]
+    oracle = oracle.reshape( oracle.shape[0] , -1 )
+    stack = stack.reshape( nimg , oracle.shape[0] , -1 )
+    nrows , ncols = oracle.shape
+    nstep = max( 1 , chunk_size // ( ncols * nimg ) )
+
+    if integer_domain( oracle , stack ) is True:
+        wtype = np.int64
+    else:
+        wtype = myfloat
+
+    sum_r2 = 0;  max_r = -np.inf
+    sum_d2 = np.zeros( nimg , dtype=wtype )
+    sum_ad = np.zeros( nimg , dtype=wtype )
+    max_ad = np.zeros( nimg , dtype=wtype )
+
+    for i in range( 0 , nrows , nstep ):
+        r = oracle[i:i+nstep,:].astype( wtype ).reshape( -1 )
+        d = r - stack[:,i:i+nstep,:].reshape( nimg , -1 )
+        sum_r2 += np.dot( r , r ).item()
+        max_r = max( max_r , np.max( r ).item() )
+        sum_d2 += np.einsum( 'ij,ij->i' , d , d )
+        np.abs( d , out=d )
+        sum_ad += np.sum( d , axis=1 )
+        np.maximum( max_ad , np.max( d , axis=1 ) , out=max_ad )
+
+    results = np.column_stack( figures_of_merit( nrows * ncols , sum_r2 , sum_d2 ,
+                                                 sum_ad , max_ad , max_r ) )
+
+    if maxerr is True:
+        return results
+    else:
+        return results[:,:4]
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####         SLICE BY SLICE EVALUATION OF VOLUMES      ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Oracle and test volume, also memory-mapped, are walked once
+##  along the first axis, a slab of contiguous slices at a time,
+##  whatever the "axis" of the analysis: the sums of each slice
+##  along "axis" are reductions of the slab over the two other axes,
+##  added to the totals of the slices, so that a memory-mapped file
+##  is read only once and in the order of its layout.
+##  Output: array ( nslices , 5 ) with SNR , PSNR , RMSE , MAE ,
+##  MAXERR of each slice and the same 5 values for the whole volume
+
+def calc_metrics_slices( oracle , image , axis=0 ):
+    if oracle.shape != image.shape:
+        sys.exit('\nERROR: The input volumes have different shapes!\n')
+
+    if oracle.ndim != 3:
+        sys.exit('\nERROR: The slice by slice analysis requires 3D volumes!\n')
+
+    nslices = oracle.shape[axis]
+    npix = oracle.size // nslices
+    nstep = max( 1 , chunk_size // ( oracle.shape[1] * oracle.shape[2] ) )
+
+    ##  Reductions of a slab ( z , y , x ) to the slices along "axis"
+    subscripts = 'zyx,zyx->' + 'zyx'[axis]
+    other = tuple( a for a in range( 3 ) if a != axis )
+
+    if integer_domain( oracle , image ) is True:
+        wtype = np.int64
+    else:
+        wtype = myfloat
+
+    sum_r2 = np.zeros( nslices , dtype=wtype )
+    sum_d2 = np.zeros( nslices , dtype=wtype )
+    sum_ad = np.zeros( nslices , dtype=wtype )
+    max_ad = np.zeros( nslices , dtype=wtype )
+    if wtype == np.int64:
+        max_r = np.full( nslices , np.iinfo( np.int64 ).min , dtype=wtype )
+    else:
+        max_r = np.full( nslices , -np.inf , dtype=wtype )
+
+    for i in range( 0 , oracle.shape[0] , nstep ):
+        r = oracle[i:i+nstep].astype( wtype )
+        d = r - image[i:i+nstep]
+
+        ##  Along the first axis each slab holds whole slices, along the
+        ##  other axes each slab adds to all the slices
+        if axis == 0:
+            sl = slice( i , i + r.shape[0] )
+        else:
+            sl = slice( None )
+
+        sum_r2[sl] += np.einsum( subscripts , r , r )
+        max_r[sl] = np.maximum( max_r[sl] , np.max( r , axis=other ) )
+        sum_d2[sl] += np.einsum( subscripts , d , d )
+        np.abs( d , out=d )
+        sum_ad[sl] += np.sum( d , axis=other )
+        max_ad[sl] = np.maximum( max_ad[sl] , np.max( d , axis=other ) )
+
+    results_slices = np.column_stack( figures_of_merit( npix , sum_r2 , sum_d2 ,
+                                                        sum_ad , max_ad , max_r ) )
+
+    ##  Global values from the per-slice sums, accumulated as python
+    ##  numbers so that integer sums stay exact
+    total = int if wtype == np.int64 else float
+    results_global = np.array( figures_of_merit( nslices * npix ,
+                                                 sum( total( v ) for v in sum_r2 ) ,
+                                                 sum( total( v ) for v in sum_d2 ) ,
+                                                 sum( total( v ) for v in sum_ad ) ,
+                                                 np.max( max_ad ) , np.max( max_r ) ) ,
+                               dtype=myfloat )
+
+    return results_slices , results_global
+
+
+
+##  Table with one row per slice and a last row for the whole volume;
+##  in the .npy format the index of the last row is -1
+
+def write_slice_table( fileout , results_slices , results_global ):
+    nslices = results_slices.shape[0]
+    table = np.zeros( ( nslices + 1 , 6 ) , dtype=myfloat )
+    table[:nslices,0] = np.arange( nslices )
+    table[:nslices,1:] = results_slices
+    table[nslices,0] = -1
+    table[nslices,1:] = results_global
+
+    if fileout.endswith( '.npy' ):
+        np.save( fileout , table )
+    else:
+        fp = open( fileout , 'w' )
+        fp.write( 'slice,SNR,PSNR,RMSE,MAE,MAXERR\n' )
+        for i in range( nslices ):
+            fp.write( str( i ) + ',' + ','.join( [ '%.12g' % v for v in results_slices[i] ] ) + '\n' )
+        fp.write( 'global,' + ','.join( [ '%.12g' % v for v in results_global ] ) + '\n' )
+        fp.close()
 
 
 
@@ -233,13 +865,18 @@ def calc_mae( oracle , image ):
 
 def write_log_file( args , image_list , results ): 
     ##  Open the file
+    if args.stack is not None:
+        filein = args.stack
+    else:
+        filein = args.image2
+
     if args.logpath is None:
-        fileout = args.image2[:len(args.image2)-4] + '_psnr_analysis.txt'
+        fileout = filein[:len(filein)-4] + '_psnr_analysis.txt'
     else:
         logpath = args.logpath
         if logpath[len(logpath)-1] != '/':
             logpath += '/'
-        chunks = args.image2[:len(args.image2)-4].split( '/' )
+        chunks = filein[:len(filein)-4].split( '/' )
         name   = chunks[len(chunks)-1]
         fileout = logpath + name + '_snr.txt'          
     fp = open( fileout , 'w' )  
@@ -310,6 +947,7 @@ def write_log_file( args , image_list , results ):
         fp.write('\nPSNR = ' + str( results[i][1] ))   
         fp.write('\nRMSE = ' + str( results[i][2] ))   
         fp.write('\nMAE = ' + str( results[i][3] ))
+        fp.write('\nMAXERR = ' + str( results[i][4] ))
 
     fp.write('\n')
 
@@ -349,7 +987,8 @@ def main():
     ##  Get oracle image 
     currDir = os.getcwd()
     image1 = io.readImage( args.image1 )
-    image1 = image1.astype(myfloat)
+    if args.axis is None:
+        image1 = cast_image( image1 , args )
     
     print('\nReading reference image:\n', args.image1)
     print('Image shape: ', image1.shape)
@@ -360,12 +999,59 @@ def main():
 
     
     
+    ##  CASE OF STACK OF IMAGES TO ANALYZE
+    if args.stack is not None:
+        stack = io.readImage( args.stack )
+        num_img = stack.shape[0]
+        image_list = [ args.stack + ' , image ' + str( i ) for i in range( num_img ) ]
+
+        print('\nReading stack of images to analyze:\n', args.stack)
+        print('Stack shape: ', stack.shape)
+
+
+        ##  Get time in which the prgram starts to run
+        time1 = time.time()
+
+
+        ##  Compute figures of merit of all the images of the stack
+        results = calc_metrics_batch( image1 , stack , maxerr=True )
+
+
+
+    ##  CASE OF VOLUME TO ANALYZE SLICE BY SLICE
+    elif args.axis is not None:
+        image2 = io.readImage( args.image2 )
+        image_list.append( args.image2 )
+        num_img = 1
+
+        print('\nReading volume to analyze:\n', args.image2)
+        print('Volume shape: ', image2.shape)
+        print('Analysis slice by slice along axis: ', args.axis)
+
+
+        ##  Get time in which the prgram starts to run
+        time1 = time.time()
+
+
+        ##  Compute figures of merit of each slice and of the volume
+        results_slices , results_global = calc_metrics_slices( image1 , image2 , args.axis )
+        results.append( results_global )
+
+
+        ##  Write table
+        if args.table is None:
+            args.table = args.image2[:len(args.image2)-4] + '_slices.csv'
+        write_slice_table( args.table , results_slices , results_global )
+        print('\nWritten table of the slice by slice analysis:\n', args.table)
+
+
+
     ##  CASE OF SINGLE IMAGE TO ANALYZE
-    if args.image2 is not None:
+    elif args.image2 is not None:
         if args.image2.find( ':' ) == -1:
             image_list.append( args.image2 )
             image2 = io.readImage( args.image2 ) 
-            image2 = image2.astype(myfloat)
+            image2 = cast_image( image2 , args )
             num_img = 1
             
             print('\nReading image to analyze:\n', args.image2)
@@ -412,20 +1098,20 @@ def main():
 
                 else:
                     print('\nUsing pixels specified in file:\n', roi)
-                    file_roi = open( roi , 'r' )
-                    pixels = np.loadtxt( file_roi )
-                    image1 = image1[pixels[:,0],pixels[:,1]]
-                    image2 = image2[pixels[:,0],pixels[:,1]]
-                    num_pix = len( image1 )
-                    fact = factors( num_pix )
-                    image1 = image1.reshape( fact[0] , int( num_pix/fact[0] ) )
-                    image2 = image2.reshape( fact[0] , int( num_pix/fact[0] ) )   
+                    roi_mask = load_roi_mask( roi , image1.shape )
 
 
             ##  Compute the gradient of the images, if enabled
             if args.gradient is True:
                 image1 = compute_gradient_image( image1 )
-                image2 = compute_gradient_image( image2 )      
+                image2 = compute_gradient_image( image2 )
+
+
+            ##  Gather the pixels of the ROI file, if selected; the metrics
+            ##  are computed directly on the flat array of masked pixels
+            if args.roi is not None and args.roi.find(',') == -1:
+                image1 = image1[roi_mask]
+                image2 = image2[roi_mask]
 
 
             ##  Check whether the 2 images have the same shape
@@ -434,7 +1120,7 @@ def main():
 
 
             ##  Plot to check whether the images have the same orientation
-            if args.plot is True:
+            if args.plot is True and image1.ndim == 2:
                 print('\nPlotting images to check orientation ....')
                 img_list = [ image1 , image2 ]
                 title_list = [ 'Oracle image' , 'Image to analyze' ]
@@ -442,12 +1128,20 @@ def main():
 
 
             ##  Compute figures of merit
-            SNR = calc_snr( image1 , image2 )
-            PSNR = calc_psnr( image1 , image2 )
-            RMSE = calc_rmse( image1 , image2 )
-            MAE = calc_rmse( image1 , image2 ) 
+            stats = ErrorStats( args.quantiles ).update( image1 , image2 )
+            SNR , PSNR , RMSE , MAE , MAXERR = stats.metrics()
+
+            results.append( np.array( [ SNR , PSNR , RMSE , MAE , MAXERR ] ) )
+
+
+            ##  Quantiles and histogram of the absolute error, if enabled
+            if args.quantiles is True:
+                write_error_quantiles( stats , args.image2 )
 
-            results.append( np.array( [ SNR , PSNR , RMSE , MAE ] ) )
+
+            ##  Write maps of local errors, if enabled
+            if args.local_map is not None:
+                write_local_error_maps( image1 , image2 , args.image2 , args )
 
 
 
@@ -462,7 +1156,7 @@ def main():
                 img_file = image_list[im]
                 image1 = io.readImage( args.image1 )
                 image2 = io.readImage( img_file )  # image2 --> image to analyze
-                image2 = image2.astype(myfloat)
+                image2 = cast_image( image2 , args )
                 print('\nReading image to analyze:\n', args.image2)
                 print('Image shape: ', image2.shape)
 
@@ -507,22 +1201,20 @@ def main():
 
                     else:
                         print('\nUsing pixels specified in file:\n', roi) 
-                        file_roi = open( roi , 'r' )
-                        pixels = np.loadtxt( file_roi )
-                        pixels = pixels.astype( int )
-
-                        image1 = image1[pixels[:,0],pixels[:,1]]
-                        image2 = image2[pixels[:,0],pixels[:,1]]
-                        num_pix = len( image1 )
-                        fact = factors( num_pix )
-                        image1 = image1.reshape( fact[0] , int( num_pix/fact[0] ) )
-                        image2 = image2.reshape( fact[0] , int( num_pix/fact[0] ) )       
+                        roi_mask = load_roi_mask( roi , image1.shape )
 
 
                 ##  Compute the gradient of the images, if enabled
                 if args.gradient is True:
                     image1 = compute_gradient_image( image1 )
-                    image2 = compute_gradient_image( image2 )      
+                    image2 = compute_gradient_image( image2 )
+
+
+                ##  Gather the pixels of the ROI file, if selected; the metrics
+                ##  are computed directly on the flat array of masked pixels
+                if args.roi is not None and args.roi.find(',') == -1:
+                    image1 = image1[roi_mask]
+                    image2 = image2[roi_mask]
                 
                 
                 ##  Check whether the 2 images have the same shape
@@ -531,7 +1223,7 @@ def main():
 
 
                 ##  Plot to check whether the images have the same orientation
-                if args.plot is True:
+                if args.plot is True and image1.ndim == 2:
                     print('\nPlotting images to check orientation ....')
                     img_list2 = [ image1 , image2 ]
                     title_list2 = [ 'Oracle image' , 'Image to analyze' ]
@@ -539,12 +1231,20 @@ def main():
 
 
                 ##  Compute figures of merit
-                SNR = calc_snr( image1 , image2 )
-                PSNR = calc_psnr( image1 , image2 )
-                RMSE = calc_rmse( image1 , image2 )
-                MAE = calc_rmse( image1 , image2 )
+                stats = ErrorStats( args.quantiles ).update( image1 , image2 )
+                SNR , PSNR , RMSE , MAE , MAXERR = stats.metrics()
+
+                results.append( np.array( [ SNR , PSNR , RMSE , MAE , MAXERR ] ) )
+
+
+                ##  Quantiles and histogram of the absolute error, if enabled
+                if args.quantiles is True:
+                    write_error_quantiles( stats , img_file )
+
 
-                results.append( np.array( [ SNR , PSNR , RMSE , MAE ] ) )                                  
+                ##  Write maps of local errors, if enabled
+                if args.local_map is not None:
+                    write_local_error_maps( image1 , image2 , img_file , args )
 
 
 
@@ -562,7 +1262,7 @@ def main():
         for i in range( num_img ):
             image1 = io.readImage( args.image1 )
             image2 = io.readImage( image_list[i] )
-            image2 = image2.astype(myfloat)
+            image2 = cast_image( image2 , args )
             print('\n\n\nIMAGE TO ANALYZE NUMBER: ', i)
             print('\nReading image to analyze:\n', image_list[i])
             print('Image shape: ', image2.shape)
@@ -607,16 +1307,7 @@ def main():
 
                 else:
                     print('\nUsing pixels specified in file:\n', roi) 
-                    file_roi = open( roi , 'r' )
-                    pixels = np.loadtxt( file_roi )
-                    pixels = pixels.astype( int )
-
-                    image1 = image1[pixels[:,0],pixels[:,1]]
-                    image2 = image2[pixels[:,0],pixels[:,1]]
-                    num_pix = len( image1 )
-                    fact = factors( num_pix )
-                    image1 = image1.reshape( fact[0] , int( num_pix/fact[0] ) )
-                    image2 = image2.reshape( fact[0] , int( num_pix/fact[0] ) ) 
+                    roi_mask = load_roi_mask( roi , image1.shape )
 
 
                 ##  Check whether the 2 images have the same shape
@@ -630,8 +1321,15 @@ def main():
                 image2 = compute_gradient_image( image2 )
 
 
+            ##  Gather the pixels of the ROI file, if selected; the metrics
+            ##  are computed directly on the flat array of masked pixels
+            if args.roi is not None and args.roi.find(',') == -1:
+                image1 = image1[roi_mask]
+                image2 = image2[roi_mask]
+
+
             ##  Plot to check whether the images have the same orientation
-            if args.plot is True and args.roi.find(',') != -1:
+            if args.plot is True and image1.ndim == 2:
                 print('\nPlotting images to check orientation ....')
                 img_list2 = [ image1 , image2 ]
                 title_list2 = [ 'Oracle image' , 'Image to analyze' ]
@@ -639,12 +1337,20 @@ def main():
 
 
             ##  Compute figures of merit
-            SNR = calc_snr( image1 , image2 )
-            PSNR = calc_psnr( image1 , image2 )
-            RMSE = calc_rmse( image1 , image2 )
-            MAE = calc_rmse( image1 , image2 )
+            stats = ErrorStats( args.quantiles ).update( image1 , image2 )
+            SNR , PSNR , RMSE , MAE , MAXERR = stats.metrics()
+
+            results.append( np.array( [ SNR , PSNR , RMSE , MAE , MAXERR ] ) )
+
+
+            ##  Quantiles and histogram of the absolute error, if enabled
+            if args.quantiles is True:
+                write_error_quantiles( stats , image_list[i] )
+
 
-            results.append( np.array( [ SNR , PSNR , RMSE , MAE ] ) )  
+            ##  Write maps of local errors, if enabled
+            if args.local_map is not None:
+                write_local_error_maps( image1 , image2 , image_list[i] , args )
 
 
         os.chdir(currDir)
@@ -661,6 +1367,7 @@ def main():
         print('PSNR = ' , results[i][1])   
         print('MRSE = ' , results[i][2])   
         print('MAE = ' , results[i][3])   
+        print('MAXERR = ' , results[i][4])
 
 
 
@@ -17,6 +17,8 @@ import sys
 import os
 import glob
 import datetime
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 
@@ -38,8 +40,24 @@ myFloat = np.float64
 
 
 ####  CONSTANTS
+##  Probability below which the bins of the joint histogram are
+##  neglected in the joint entropy, up to 256 bins ( "joint_threshold" );
+##  also the entropy below which a window of the local NMI map is flat
 eps = 1e-5
 
+##  The joint histogram is built sparse when the number of its
+##  bins, nbins^2, exceeds "sparse_ratio" times the number of pixels
+sparse_ratio = 1
+
+##  Maximum number of bins of the joint histograms held by a row
+##  block of the local NMI map, one joint histogram per row over
+##  the joint bins occupied in the block
+local_hist_size = 2**22
+
+##  Information metrics computed from the joint histogram
+metric_names = [ 'NMI' , 'MI' , 'NMI_sum' , 'NMI_joint' , 'NMI_sqrt' , 'NMI_max' ,
+                 'ECC' , 'VI' , 'NVI' ]
+
 
 
 
@@ -70,9 +88,32 @@ def getArgs():
                         help = 'Select vertices of the region of interest; e.g. -r x0:y0,x1:y1'
                         + ' or select roi-file: e.g. -r path/file')  
 
-    parser.add_argument('-b', '--nbins', dest='nbins', type=np.int, default=256,
+    parser.add_argument('-b', '--nbins', dest='nbins', type=int, default=256,
                         help = 'Enable analisys only inside the resolution circle')  
     
+    parser.add_argument('-v', '--volume', dest='volume', action='store_true',
+                        help = 'Compute the NMI of two volumes in two streaming passes'
+                        + ' over chunks of slices, with bounded memory; .npy volumes'
+                        + ' are memory-mapped')
+
+    parser.add_argument('-n', '--nproc', dest='nproc', type=int, default=1,
+                        help = 'Number of worker processes for the volume NMI'
+                        + ' and of threads for the joint histograms of images'
+                        + ' and for the local NMI map')
+
+    parser.add_argument('-l', '--local_map', dest='local_map', type=int,
+                        help = 'Write the map of local NMI computed on a square'
+                        + ' window of the selected odd size; e.g. -l 15')
+
+    parser.add_argument('-m', '--metrics', dest='metrics', default='NMI',
+                        help = 'Select the information metrics to log, separated'
+                        + ' by ",", or "all": ' + ' , '.join( metric_names ) )
+
+    parser.add_argument('-w', '--sweep', dest='sweep',
+                        help = 'Sweep of numbers of bins separated by ",", e.g.'
+                        + ' 32,64,128,256,512,1024: the images are quantized once'
+                        + ' with the largest one and each other must divide it')
+
     parser.add_argument('-o', '--fileout', dest='fileout',
                         help='Select an output text file with the'
                         +' outcomes of the SSIM calculation')
@@ -100,6 +141,31 @@ def getArgs():
         sys.exit('\nERROR: Neither single image nor bunch of images'
                  + ' to analyze specified!\n')     
     
+    if args.sweep is not None:
+        if args.image2 is None or args.image2.find( ':' ) != -1:
+            parser.print_help()
+            sys.exit('\nERROR: The bin sweep works on a single image to analyze!\n')
+
+        args.sweep = sorted( [ int( n ) for n in args.sweep.split(',') ] )
+        for n in args.sweep:
+            if n < 2 or args.sweep[-1] % n != 0:
+                parser.print_help()
+                sys.exit('\nERROR: Number of bins ' + str( n ) + ' does not divide '
+                         + str( args.sweep[-1] ) + '!\n')
+
+    if args.local_map is not None and args.local_map % 2 == 0:
+        parser.print_help()
+        sys.exit('\nERROR: The window of the local NMI map must have odd size!\n')
+
+    if args.metrics == 'all':
+        args.metrics = metric_names
+    else:
+        args.metrics = args.metrics.split(',')
+        for name in args.metrics:
+            if name not in metric_names:
+                parser.print_help()
+                sys.exit('\nERROR: Information metric ' + name + ' not available!\n')
+
     if args.fileout is None:
         print('\nWarning: no output text file specified\n')
 
@@ -116,60 +182,619 @@ def getArgs():
 ###########################################################
 ########################################################### 
 
-def computeNMI( image1 , image2 , nbins ):
-    ##  Allocate memory for the quantized versions of the input images
-    nrows , ncols = image1.shape
-    imq1 = np.zeros( ( nrows , ncols ) , dtype=np.int )
-    imq2 = np.zeros( ( nrows , ncols ) , dtype=np.int )    
+##  Entropy of a histogram of "npix" counts; the probabilities
+##  smaller than "threshold" are neglected
 
+def entropy( histo , npix , threshold=0.0 ):
+    histo = histo[histo != 0].astype( np.float32 ) / np.float32( npix )
+    histo = histo[histo > threshold]
+    return -np.sum( histo * np.log2( histo ) )
 
-    ##  Quantize images  with the given number of bins
-    min1 = np.min( image1 );  max1 = np.max( image1 )
-    min2 = np.min( image2 );  max2 = np.max( image2 )
 
-    imq1[:,:] = np.array( ( image1 - min1 ) * ( nbins - 1 ) / ( max1 - min1 ) ).astype( np.int )
-    imq2[:,:] = np.array( ( image2 - min2 ) * ( nbins - 1 ) / ( max2 - min2 ) ).astype( np.int )
 
+##  Sparse joint histogram for large numbers of bins, e.g. 65536 for
+##  raw 16-bit data, where the dense nbins X nbins array does not fit
+##  in memory: only the occupied bins are returned, as sorted pair
+##  codes imq1 * nbins + imq2 with their counts
 
-    ##  Create normalized histograms of the quantized images
-    histo1 , bin_edges = np.histogram( imq1 , nbins )
-    histo2 , bin_edges = np.histogram( imq2 , nbins )
+def joint_histogram_sparse( imq1 , imq2 , nbins ):
+    index = imq1.reshape( -1 ).astype( np.int64 ) * nbins + imq2.reshape( -1 )
+    codes , counts = np.unique( index , return_counts=True )
+    return codes , counts
 
-    ind = np.argwhere( histo1 != 0 )
-    histo1 = np.array( histo1[ind] ).astype( np.float32 )
 
-    ind = np.argwhere( histo2 != 0 )
-    histo2 = np.array( histo2[ind] ).astype( np.float32 )      
 
+def use_sparse_histogram( nbins , npix ):
+    return nbins * nbins > sparse_ratio * npix
 
-    histo1 /= np.float( nrows * ncols )
-    histo2 /= np.float( nrows * ncols )
 
 
-    ##  Compute entropies
-    H1 = -np.sum( histo1 * np.log2( histo1 ) )
-    H2 = -np.sum( histo2 * np.log2( histo2 ) )
+##  Probability threshold of the joint entropy: "eps" up to 256 bins,
+##  scaled with 1 / nbins^2 beyond, so that it stays well below the
+##  mean probability of a joint bin; otherwise with e.g. 65536 bins
+##  nearly all the occupied bins would be neglected and H12 would be 0
 
+def joint_threshold( nbins ):
+    return eps * min( 1.0 , ( 256.0 / nbins )**2 )
 
-    ##  Compute joint histogram for H(1,2)
-    J = np.zeros( ( nbins , nbins ) , dtype=np.float32 )
-    
-    for i in range( nrows ):
-        for j in range( ncols ):
-            J[imq1[i,j],imq2[i,j]] += 1
-    
-    J /= np.float32( nrows * ncols )
-    ind = np.argwhere( J > eps )
-    J = J[ ind[:,0], ind[:,1] ]
 
-    H12 = -np.sum( J * np.log2( J ) )
+
+##  Quantization of an image with "nbins" bins in the smallest
+##  unsigned integer type able to hold the bin indices
+
+def quantize( image , nbins , vmin=None , vmax=None ):
+    if vmin is None:
+        vmin = np.min( image )
+    if vmax is None:
+        vmax = np.max( image )
+
+    if nbins <= 2**8:
+        qtype = np.uint8
+    elif nbins <= 2**16:
+        qtype = np.uint16
+    else:
+        qtype = np.uint32
+
+    ##  Integer chunks, e.g. of 16-bit volumes, are cast to float
+    ##  to avoid the overflow of the scaling
+    image = np.asarray( image , dtype=myFloat )
+    vmin = myFloat( vmin );  vmax = myFloat( vmax )
+
+    return np.array( ( image - vmin ) * ( nbins - 1 ) / ( vmax - vmin ) ).astype( qtype )
+
+
+
+##  Nested quantization floor( ( x - vmin ) / ( vmax - vmin ) * nbins ):
+##  for every "n" dividing "nbins" the bin index with "n" bins is the
+##  one with "nbins" bins divided by nbins / n, so that coarser joint
+##  histograms are obtained by block-summing the finest one.
+##  Note that this differs slightly from the ( nbins - 1 ) scaling of
+##  "quantize", hence the sweep NMI are not identical to single runs
+
+def quantize_nested( image , nbins , vmin , vmax ):
+    imq = np.floor( ( image - vmin ) * ( nbins / ( vmax - vmin ) ) )
+    return np.clip( imq , 0 , nbins - 1 ).astype( np.uint32 )
+
+
+
+##  Family of information metrics from the entropies H1 , H2 , H12
+##  of the same joint histogram:
+##  NMI       ---> ( H1 + H2 - H12 ) / H1 , normalized by the reference
+##  MI        ---> mutual information  MI = H1 + H2 - H12
+##  NMI_sum   ---> ( H1 + H2 ) / H12 , Studholme
+##  NMI_joint ---> MI / H12
+##  NMI_sqrt  ---> MI / sqrt( H1 * H2 )
+##  NMI_max   ---> MI / max( H1 , H2 )
+##  ECC       ---> entropy correlation coefficient  2 * MI / ( H1 + H2 )
+##  VI        ---> variation of information  H1 + H2 - 2 * MI
+##  NVI       ---> normalized variation of information  VI / H12
+
+def information_metrics( H1 , H2 , H12 ):
+    MI = H1 + H2 - H12
+    VI = H1 + H2 - 2 * MI
+
+    return { 'NMI'       : MI / np.max( np.abs( H1 ) ) ,
+             'MI'        : MI ,
+             'NMI_sum'   : ( H1 + H2 ) / H12 ,
+             'NMI_joint' : MI / H12 ,
+             'NMI_sqrt'  : MI / np.sqrt( H1 * H2 ) ,
+             'NMI_max'   : MI / max( H1 , H2 ) ,
+             'ECC'       : 2 * MI / ( H1 + H2 ) ,
+             'VI'        : VI ,
+             'NVI'       : VI / H12 }
 
 
-    ##  Compute normalized mutual information
-    NMI = ( H1 + H2 - H12 ) / np.max( np.abs( H1 ) )
 
+##  Evaluator of the NMI of many test images with respect to the
+##  same reference: quantized reference, its min/max, marginal
+##  histogram and entropy H1 are computed only once, so that each
+##  test image costs one quantization and one joint bincount
 
-    return NMI
+class NMIEvaluator:
+    def __init__ ( self , reference , nbins , nthreads=1 ):
+        ##  Number of bins
+        self.nbins = nbins
+
+        ##  Number of threads building the joint histogram
+        self.nthreads = nthreads
+
+        ##  Number of pixels
+        self.npix = reference.size
+        self.shape = reference.shape
+
+        ##  Range and quantized version of the reference
+        self.min1 = np.min( reference )
+        self.max1 = np.max( reference )
+        self.imq1 = quantize( reference , nbins , self.min1 , self.max1 )
+
+        ##  Marginal histogram and entropy of the reference
+        self.histo1 = np.bincount( self.imq1.reshape( -1 ) , minlength=nbins )
+        self.H1 = entropy( self.histo1 , self.npix )
+
+        ##  Dense or sparse joint histogram
+        self.sparse = use_sparse_histogram( nbins , self.npix )
+
+
+    ##  ENTROPIES H1 , H2 , H12 OF REFERENCE AND TEST IMAGE
+    def entropies( self , image ):
+        if image.shape != self.shape:
+            sys.exit('\nERROR: The input images have different shapes!\n')
+
+        ##  Quantize test image
+        imq2 = quantize( image , self.nbins )
+
+        ##  Compute joint histogram for H(1,2) and marginal histogram
+        ##  of the test image, from the joint one if it is dense
+        if self.sparse is True:
+            codes , J = joint_histogram_sparse( self.imq1 , imq2 , self.nbins )
+            histo2 = np.bincount( imq2.reshape( -1 ) , minlength=self.nbins )
+        else:
+            J = proc.joint_histogram( self.imq1 , imq2 , self.nbins , self.nthreads )
+            histo2 = np.sum( J , axis=0 )
+
+        ##  Compute entropies
+        H2 = entropy( histo2 , self.npix )
+        H12 = entropy( J , self.npix , joint_threshold( self.nbins ) )
+
+        return self.H1 , H2 , H12
+
+
+    ##  ALL THE INFORMATION METRICS OF A TEST IMAGE
+    def evaluate_all( self , image ):
+        return information_metrics( *self.entropies( image ) )
+
+
+    ##  NMI OF A TEST IMAGE
+    def evaluate( self , image ):
+        H1 , H2 , H12 = self.entropies( image )
+
+        ##  Compute normalized mutual information
+        NMI = ( H1 + H2 - H12 ) / np.max( np.abs( H1 ) )
+
+        return NMI
+
+
+
+def computeNMI( image1 , image2 , nbins , nthreads=1 ):
+    return NMIEvaluator( image1 , nbins , nthreads ).evaluate( image2 )
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####       CHUNKED NMI OF VOLUMES AND OUT-OF-CORE DATA ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Mergeable joint histogram: filled chunk by chunk with images
+##  quantized on the global ranges, partial histograms of different
+##  chunks or worker processes are combined with "merge" by adding
+##  their counts, so that the result equals the one on full arrays.
+##  The sparse version stores only the occupied bins.
+
+class JointHistogram:
+    def __init__ ( self , nbins , sparse=False , nthreads=1 ):
+        ##  Number of bins
+        self.nbins = nbins
+
+        ##  Number of threads building the dense histogram of a chunk
+        self.nthreads = nthreads
+
+        ##  Number of pixels accumulated so far
+        self.npix = 0
+
+        ##  Dense nbins X nbins counts or sorted pair codes with counts
+        self.sparse = sparse
+        if sparse is True:
+            self.codes = np.zeros( 0 , dtype=np.int64 )
+            self.counts = np.zeros( 0 , dtype=np.int64 )
+        else:
+            self.J = np.zeros( ( nbins , nbins ) , dtype=np.int64 )
+
+
+    ##  ADD SPARSE COUNTS
+    def add_codes( self , codes , counts ):
+        codes = np.concatenate( ( self.codes , codes ) )
+        counts = np.concatenate( ( self.counts , counts ) )
+        self.codes , ind = np.unique( codes , return_inverse=True )
+        self.counts = np.bincount( ind.reshape( -1 ) , weights=counts ).astype( np.int64 )
+
+
+    ##  ADD A CHUNK OF QUANTIZED IMAGES
+    def update( self , imq1 , imq2 ):
+        if self.sparse is True:
+            codes , counts = joint_histogram_sparse( imq1 , imq2 , self.nbins )
+            self.add_codes( codes , counts )
+        else:
+            self.J += proc.joint_histogram( imq1 , imq2 , self.nbins , self.nthreads )
+
+        self.npix += imq1.size
+
+        return self
+
+
+    ##  COMBINE WITH THE HISTOGRAM OF AN OTHER SET OF CHUNKS
+    def merge( self , other ):
+        if other.sparse is True:
+            if self.sparse is True:
+                self.add_codes( other.codes , other.counts )
+            else:
+                np.add.at( self.J.reshape( -1 ) , other.codes , other.counts )
+        else:
+            if self.sparse is True:
+                codes = np.flatnonzero( other.J )
+                self.add_codes( codes , other.J.reshape( -1 )[codes] )
+            else:
+                self.J += other.J
+
+        self.npix += other.npix
+
+        return self
+
+
+    ##  MARGINAL HISTOGRAMS
+    def marginals( self ):
+        if self.sparse is True:
+            nbins = self.nbins
+            histo1 = np.bincount( self.codes // nbins , weights=self.counts , minlength=nbins )
+            histo2 = np.bincount( self.codes % nbins , weights=self.counts , minlength=nbins )
+            return histo1.astype( np.int64 ) , histo2.astype( np.int64 )
+        else:
+            return np.sum( self.J , axis=1 ) , np.sum( self.J , axis=0 )
+
+
+    ##  ENTROPIES H1 , H2 , H12
+    def entropies( self ):
+        histo1 , histo2 = self.marginals()
+
+        if self.sparse is True:
+            J = self.counts
+        else:
+            J = self.J
+
+        return entropy( histo1 , self.npix ) , entropy( histo2 , self.npix ) , \
+               entropy( J , self.npix , joint_threshold( self.nbins ) )
+
+
+    ##  JOINT HISTOGRAM WITH A NUMBER OF BINS DIVIDING "self.nbins",
+    ##  VALID FOR NESTED QUANTIZATION
+    def coarsen( self , nbins ):
+        factor = self.nbins // nbins
+        sparse = use_sparse_histogram( nbins , self.npix )
+        hist = JointHistogram( nbins , sparse )
+        hist.npix = self.npix
+
+        if self.sparse is True:
+            codes = ( self.codes // self.nbins // factor ) * nbins + \
+                    ( self.codes % self.nbins ) // factor
+            if sparse is True:
+                hist.add_codes( codes , self.counts )
+            else:
+                J = np.bincount( codes , weights=self.counts , minlength=nbins * nbins )
+                hist.J = J.astype( np.int64 ).reshape( nbins , nbins )
+        else:
+            J = self.J.reshape( nbins , factor , nbins , factor ).sum( axis=( 1 , 3 ) )
+            if sparse is True:
+                codes = np.flatnonzero( J )
+                hist.add_codes( codes , J.reshape( -1 )[codes] )
+            else:
+                hist.J = J
+
+        return hist
+
+
+    ##  ALL THE INFORMATION METRICS
+    def metrics( self ):
+        return information_metrics( *self.entropies() )
+
+
+    ##  NORMALIZED MUTUAL INFORMATION
+    def nmi( self ):
+        H1 , H2 , H12 = self.entropies()
+        return ( H1 + H2 - H12 ) / np.max( np.abs( H1 ) )
+
+
+
+##  First pass: global range of a volume, chunk by chunk
+
+def value_range( volume , nslices=1 ):
+    vmin = np.inf;  vmax = -np.inf
+
+    for i in range( 0 , volume.shape[0] , nslices ):
+        chunk = volume[i:i+nslices]
+        vmin = min( vmin , np.min( chunk ) )
+        vmax = max( vmax , np.max( chunk ) )
+
+    return vmin , vmax
+
+
+
+##  Second pass: joint histogram of the chunks quantized on the
+##  global ranges
+
+def joint_histogram_stream( vol1 , vol2 , nbins , range1 , range2 , sparse , nslices=1 ):
+    hist = JointHistogram( nbins , sparse )
+
+    for i in range( 0 , vol1.shape[0] , nslices ):
+        imq1 = quantize( vol1[i:i+nslices] , nbins , range1[0] , range1[1] )
+        imq2 = quantize( vol2[i:i+nslices] , nbins , range2[0] , range2[1] )
+        hist.update( imq1 , imq2 )
+
+    return hist
+
+
+
+def joint_histogram_volume( vol1 , vol2 , nbins , nslices=1 ):
+    if vol1.shape != vol2.shape:
+        sys.exit('\nERROR: The input volumes have different shapes!\n')
+
+    range1 = value_range( vol1 , nslices )
+    range2 = value_range( vol2 , nslices )
+    sparse = use_sparse_histogram( nbins , vol1.size )
+
+    return joint_histogram_stream( vol1 , vol2 , nbins , range1 , range2 , sparse , nslices )
+
+
+
+def computeNMI_stream( vol1 , vol2 , nbins , nslices=1 ):
+    return joint_histogram_volume( vol1 , vol2 , nbins , nslices ).nmi()
+
+
+
+##  Parallel version: each worker opens its own memory-map of the two
+##  files and processes a slab of slices, in both passes; only ranges
+##  and partial histograms are sent back and reduced
+
+def range_slab( task ):
+    filein , i0 , i1 = task
+    return value_range( io.readImage( filein )[i0:i1] )
+
+
+
+def histogram_slab( task ):
+    file1 , file2 , i0 , i1 , nbins , range1 , range2 , sparse = task
+    vol1 = io.readImage( file1 )
+    vol2 = io.readImage( file2 )
+    return joint_histogram_stream( vol1[i0:i1] , vol2[i0:i1] , nbins ,
+                                   range1 , range2 , sparse )
+
+
+
+def joint_histogram_parallel( file1 , file2 , nbins , nproc=None ):
+    if nproc is None:
+        nproc = mp.cpu_count()
+
+    vol1 = io.readImage( file1 )
+    vol2 = io.readImage( file2 )
+    if vol1.shape != vol2.shape:
+        sys.exit('\nERROR: The input volumes have different shapes!\n')
+
+    bounds = np.linspace( 0 , vol1.shape[0] , nproc + 1 ).astype( int )
+    slabs = [ ( bounds[i] , bounds[i+1] ) for i in range( nproc ) ]
+    sparse = use_sparse_histogram( nbins , vol1.size )
+
+    pool = mp.Pool( nproc )
+
+    ##  First pass: global ranges
+    ranges1 = pool.map( range_slab , [ ( file1 , i0 , i1 ) for i0 , i1 in slabs ] )
+    ranges2 = pool.map( range_slab , [ ( file2 , i0 , i1 ) for i0 , i1 in slabs ] )
+    range1 = ( min( r[0] for r in ranges1 ) , max( r[1] for r in ranges1 ) )
+    range2 = ( min( r[0] for r in ranges2 ) , max( r[1] for r in ranges2 ) )
+
+    ##  Second pass: partial joint histograms
+    tasks = [ ( file1 , file2 , i0 , i1 , nbins , range1 , range2 , sparse ) for i0 , i1 in slabs ]
+    partials = pool.map( histogram_slab , tasks )
+    pool.close()
+    pool.join()
+
+    hist = JointHistogram( nbins , sparse )
+    for partial in partials:
+        hist.merge( partial )
+
+    return hist
+
+
+
+def computeNMI_parallel( file1 , file2 , nbins , nproc=None ):
+    return joint_histogram_parallel( file1 , file2 , nbins , nproc ).nmi()
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####             SWEEP OF THE NUMBER OF BINS           ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  The images are quantized once with the largest number of bins and
+##  a single joint histogram is built, chunk by chunk; every coarser
+##  histogram of the sweep is derived from it by block-summing;
+##  by default the images are processed as a single chunk
+
+def nmi_sweep( image1 , image2 , nbins_list , nslices=None , nthreads=1 ):
+    if image1.shape != image2.shape:
+        sys.exit('\nERROR: The input images have different shapes!\n')
+
+    if nslices is None:
+        nslices = image1.shape[0]
+
+    nbins_list = sorted( nbins_list )
+    nbins = nbins_list[-1]
+
+    range1 = value_range( image1 , nslices )
+    range2 = value_range( image2 , nslices )
+    hist = JointHistogram( nbins , use_sparse_histogram( nbins , image1.size ) , nthreads )
+
+    for i in range( 0 , image1.shape[0] , nslices ):
+        imq1 = quantize_nested( image1[i:i+nslices] , nbins , range1[0] , range1[1] )
+        imq2 = quantize_nested( image2[i:i+nslices] , nbins , range2[0] , range2[1] )
+        hist.update( imq1 , imq2 )
+
+    return [ hist.coarsen( n ).metrics() for n in nbins_list ]
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####                   LOCAL NMI MAP                   ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Table of c * log2( c ) for the counts of a window of "npix" pixels
+
+def clogc_table( npix ):
+    c = np.arange( npix + 1 , dtype=np.float64 )
+    c[0] = 1.0
+    table = c * np.log2( c )
+    return table
+
+
+
+##  Add "delta" ( +1 or -1 ) to the bins "b" of the flattened histograms,
+##  one bin per histogram, updating the running sums S = sum( c * log2( c ) )
+
+def update_histograms( histo , S , b , delta , table ):
+    c = histo[b]
+    S += table[c+delta] - table[c]
+    histo[b] = c + delta
+
+
+
+##  Codes renumbered 0 , ... , n-1 over the values occurring in a row
+##  block, so that its histograms have only n bins per row
+
+def compact_codes( codes ):
+    values , index = np.unique( codes , return_inverse=True )
+    return index.reshape( codes.shape ) , len( values )
+
+
+
+##  Local NMI of the output rows r0 , ... , r1-1: the joint and marginal
+##  histograms of the windows of all these rows are slid together along
+##  the columns, adding the entering column and removing the leaving one
+##  pixel by pixel, so that each step costs O( window ) per row instead
+##  of a rebuild; the entropies follow from the sums of c * log2( c ),
+##  H = log2( N ) - S / N with N = window^2 pixels
+
+def local_nmi_rows( task ):
+    imq1 , imq2 , window , nbins , r0 , r1 = task
+    ncols = imq1.shape[1] - window + 1
+    nrows = r1 - r0
+    npix = window * window
+    table = clogc_table( npix )
+
+    ##  Codes stored column by column, compacted over the block and
+    ##  shifted by the offset of the histogram of each row, as the
+    ##  histograms are flattened
+    codes1 = np.ascontiguousarray( imq1[r0:r1+window-1].T , dtype=np.int64 )
+    codes2 = np.ascontiguousarray( imq2[r0:r1+window-1].T , dtype=np.int64 )
+    codes12 , n12 = compact_codes( codes1 * nbins + codes2 )
+    codes1 , n1 = compact_codes( codes1 )
+    codes2 , n2 = compact_codes( codes2 )
+
+    histo1 = np.zeros( nrows * n1 , dtype=np.int32 )
+    histo2 = np.zeros( nrows * n2 , dtype=np.int32 )
+    histo12 = np.zeros( nrows * n12 , dtype=np.int32 )
+    S1 = np.zeros( nrows );  S2 = np.zeros( nrows );  S12 = np.zeros( nrows )
+
+    offset1 = np.arange( nrows ) * n1
+    offset2 = np.arange( nrows ) * n2
+    offset12 = np.arange( nrows ) * n12
+
+    def slide( col , delta ):
+        for k in range( window ):
+            update_histograms( histo1 , S1 , codes1[col,k:k+nrows] + offset1 , delta , table )
+            update_histograms( histo2 , S2 , codes2[col,k:k+nrows] + offset2 , delta , table )
+            update_histograms( histo12 , S12 , codes12[col,k:k+nrows] + offset12 , delta , table )
+
+    local_nmi = np.zeros( ( nrows , ncols ) , dtype=np.float32 )
+
+    for j in range( ncols ):
+        if j == 0:
+            for col in range( window ):
+                slide( col , 1 )
+        else:
+            slide( j - 1 , -1 )
+            slide( j + window - 1 , 1 )
+
+        H1 = np.log2( npix ) - S1 / npix
+        H2 = np.log2( npix ) - S2 / npix
+        H12 = np.log2( npix ) - S12 / npix
+
+        ##  NMI is set to 0 where the window of the reference is flat
+        flat = H1 < eps
+        H1[flat] = 1.0
+        local_nmi[:,j] = np.where( flat , 0.0 , ( H1 + H2 - H12 ) / H1 )
+
+    return local_nmi
+
+
+
+##  Number of rows of a block of the local NMI map: a block of "rows"
+##  rows holds one histogram per row over at most min( nbins^2 , pixels
+##  of the padded block ) joint bins, halved until within "local_hist_size"
+
+def local_block_rows( nrows , width , window , nbins , nthreads ):
+    rows = int( np.ceil( nrows / nthreads ) )
+
+    while rows > 1 and \
+          rows * min( nbins * nbins , ( rows + window - 1 ) * width ) > local_hist_size:
+        rows = ( rows + 1 ) // 2
+
+    return rows
+
+
+
+##  Map of local NMI on a square window of odd size: the images are
+##  quantized on their global ranges and reflect-padded, the rows are
+##  split in blocks processed by a pool of threads
+
+def calc_local_nmi_map( image1 , image2 , window , nbins , nthreads=1 ):
+    if image1.shape != image2.shape:
+        sys.exit('\nERROR: The input images have different shapes!\n')
+
+    half = window // 2
+    imq1 = np.pad( quantize( image1 , nbins ) , half , mode='reflect' )
+    imq2 = np.pad( quantize( image2 , nbins ) , half , mode='reflect' )
+
+    nrows = image1.shape[0]
+    rows = local_block_rows( nrows , imq1.shape[1] , window , nbins , nthreads )
+    tasks = [ ( imq1 , imq2 , window , nbins , r0 , min( r0 + rows , nrows ) )
+              for r0 in range( 0 , nrows , rows ) ]
+
+    if nthreads > 1:
+        pool = ThreadPool( nthreads )
+        blocks = pool.map( local_nmi_rows , tasks )
+        pool.close()
+        pool.join()
+    else:
+        blocks = [ local_nmi_rows( task ) for task in tasks ]
+
+    return np.concatenate( blocks , axis=0 )
+
+
+
+def write_local_nmi_map( image1 , image2 , filein , args ):
+    if image1.ndim != 2:
+        print('\nWarning: map of local NMI available only for 2D images')
+        return
+
+    print('\nComputing map of local NMI with window ', args.local_map, ' ....')
+    local_nmi = calc_local_nmi_map( image1 , image2 , args.local_map ,
+                                    args.nbins , args.nproc )
+
+    fileout = filein[:len(filein)-4] + '_nmi_map.tif'
+    io.writeImage( fileout , local_nmi )
+    print('Written map:\n', fileout)
 
 
 
@@ -218,7 +843,8 @@ def writeLogFile( args , image_list , results ):
     num_img = len( image_list )
     for i in range( num_img ):
         fp.write('\n\nTest image number ' + str( i ) + '\n' + image_list[i])
-        fp.write('\nNMI = ' + str( results[i] ) )
+        for name in args.metrics:
+            fp.write('\n' + name + ' = ' + str( results[i][name] ) )
 
     fp.write('\n')
 
@@ -258,19 +884,65 @@ def main():
     ## Get oracle image
     currDir = os.getcwd()
     image1 = io.readImage( args.image1 )
-    image1 = image1.astype(myFloat)
+    if args.volume is False:
+        image1 = image1.astype(myFloat)
 
     print('\nReading reference image:\n', args.image1)
     print('Image shape: ', image1.shape)
 
+    if use_sparse_histogram( args.nbins , image1.size ):
+        print('\nWarning: the joint histogram has more bins than pixels,'
+              + ' the NMI is biased upwards even for independent images')
+
 
     image_list = []
     results = []
 
     
     
+    ##  CASE OF VOLUMES ANALYZED IN STREAMING
+    if args.volume is True:
+        image_list.append( args.image2 )
+        num_img = 1
+        print('\nReading volume to analyze:\n', args.image2)
+        print('Number of bins: ', args.nbins)
+        print('Number of worker processes: ', args.nproc)
+
+
+        ##  Get time in which the prgram starts to run
+        time1 = time.time()
+
+
+        ##  Calculate NMI in two passes over chunks of slices
+        if args.nproc > 1:
+            hist = joint_histogram_parallel( args.image1 , args.image2 , args.nbins , args.nproc )
+        else:
+            hist = joint_histogram_volume( image1 , io.readImage( args.image2 ) , args.nbins )
+        results.append( hist.metrics() )
+
+
+
+    ##  CASE OF SWEEP OF THE NUMBER OF BINS
+    elif args.sweep is not None:
+        image2 = io.readImage( args.image2 )
+        num_img = len( args.sweep )
+        image_list = [ args.image2 + '  ( nbins = ' + str( n ) + ' )' for n in args.sweep ]
+        print('\nReading image to analyze:\n', args.image2)
+        print('Image shape: ', image2.shape)
+        print('Sweep of number of bins: ', args.sweep)
+
+
+        ##  Get time in which the prgram starts to run
+        time1 = time.time()
+
+
+        ##  Calculate NMI for all the numbers of bins from one joint histogram
+        results = nmi_sweep( image1 , image2 , args.sweep , nthreads=args.nproc )
+
+
+
     ##  CASE OF SINGLE IMAGE TO ANALYZE
-    if args.image2 is not None:
+    elif args.image2 is not None:
         if args.image2.find( ':' ) == -1:
             image_list.append( args.image2 )
             image2 = io.readImage( args.image2 )  # image2 --> image to analyze
@@ -350,8 +1022,13 @@ def main():
 
 
             ## Calculate map of SSIM values
-            NMI = computeNMI( image1 , image2 , nbins )
-            results.append( NMI )
+            metrics = NMIEvaluator( image1 , nbins , args.nproc ).evaluate_all( image2 )
+            results.append( metrics )
+
+
+            ##  Write map of local NMI, if enabled
+            if args.local_map is not None:
+                write_local_nmi_map( image1 , image2 , args.image2 , args )
 
 
         
@@ -361,10 +1038,12 @@ def main():
             img_list = [ ]
             title_list = [ ]
             num_img = len( image_list )
+            oracle = image1
+            evaluator = None
 
             for im in range( num_img ):
                 img_file = image_list[im]
-                image1 = io.readImage( args.image1 )
+                image1 = oracle
                 image2 = io.readImage( img_file )  # image2 --> image to analyze
                 image2 = image2.astype(myFloat)
                 print('\nReading image to analyze:\n', args.image2)
@@ -435,9 +1114,16 @@ def main():
                 print('Number of bins: ', nbins)           
 
 
-                ##  Calculate map of SSIM values
-                NMI = computeNMI( image1 , image2 , nbins )
-                results.append( NMI )
+                ##  Calculate NMI; the reference is quantized only once
+                if evaluator is None:
+                    evaluator = NMIEvaluator( image1 , nbins , args.nproc )
+                metrics = evaluator.evaluate_all( image2 )
+                results.append( metrics )
+
+
+                ##  Write map of local NMI, if enabled
+                if args.local_map is not None:
+                    write_local_nmi_map( image1 , image2 , img_file , args )
 
 
 
@@ -456,8 +1142,11 @@ def main():
 
 
         ##  Loop on all the images to analyze
+        oracle = image1
+        evaluator = None
+
         for i in range( num_img ):
-            image1 = io.readImage( args.image1 ) 
+            image1 = oracle
             image2 = io.readImage( image_list[i] )
             image2 = image2.astype(myFloat)
             
@@ -520,9 +1209,16 @@ def main():
             print('Number of bins: ', nbins)           
 
 
-            ##  Calculate map of SSIM values
-            NMI = computeNMI( image1 , image2 , nbins )
-            results.append( NMI ) 
+            ##  Calculate NMI; the reference is quantized only once
+            if evaluator is None:
+                evaluator = NMIEvaluator( image1 , nbins , args.nproc )
+            metrics = evaluator.evaluate_all( image2 )
+            results.append( metrics ) 
+
+
+            ##  Write map of local NMI, if enabled
+            if args.local_map is not None:
+                write_local_nmi_map( image1 , image2 , image_list[i] , args )
 
 
         os.chdir(currDir)
@@ -535,7 +1231,8 @@ def main():
 
     for i in range( num_img ):
         print('\n\nTest image number ', i,'\n', image_list[i],'\n')
-        print('NMI = ' , results[i])
+        for name in args.metrics:
+            print(name, ' = ' , results[i][name])
 
 
 
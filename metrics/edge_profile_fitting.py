@@ -38,8 +38,18 @@ import numpy as np
 import scipy
 from scipy import special
 from scipy import optimize
+from scipy import ndimage
 import math
 import datetime
+import multiprocessing as mp
+
+
+
+
+####  MY PYTHON MODULES
+sys.path.append('../common/')
+import my_image_io as io
+import my_image_process as proc
 
 
 
@@ -77,7 +87,29 @@ def getArgs():
 
     parser.add_argument('-i', '--filein', dest='filein',
                         help='The input is a text file printed by Fiji after'
-                        + ' having computed the profile of a line')
+                        + ' having computed the profile of a line; several files'
+                        + ' separated by ":" are processed by a pool of workers')
+
+    parser.add_argument('-im', '--image', dest='image',
+                        help='Extract the edge profile automatically from an image:'
+                        + ' the edge is detected inside the ROI and the oversampled'
+                        + ' edge spread function is built along its normal')
+
+    parser.add_argument('-r', '--roi', dest='roi',
+                        help='Select vertices of the ROI containing the edge;'
+                        + ' e.g. -r x0:y0,x1:y1')
+
+    parser.add_argument('-s', '--oversample', dest='oversample', type=int, default=4,
+                        help='Oversampling factor of the edge spread function')
+
+    parser.add_argument('-m', '--map', dest='map', action='store_true',
+                        help='With -im, detect all the edge segments of the image,'
+                        + ' fit the profile across each of them and write a sparse'
+                        + ' resolution map and a table of the segments')
+
+    parser.add_argument('-g', '--segment', dest='segment', type=int, default=16,
+                        help='Size of the grid splitting the edges in segments and'
+                        + ' half-length of the profiles for the resolution map')
 
     parser.add_argument('-o', '--fileout', dest='fileout',
                         help='You can enable an output text file where results are saved')
@@ -99,21 +131,48 @@ def getArgs():
                         + ' the four "-1" means no correction for image number 2 (in this case)')  
     
     parser.add_argument('-pr', '--prefilt', dest='prefilt', action='store_true',
-                        help='Enable prefiltering of the data')
+                        help='Enable prefiltering of the data: the plateaus on the'
+                        + ' two sides of the edge are detected automatically and'
+                        + ' replaced by their mean')
+
+    parser.add_argument('-hl', '--headless', dest='headless', action='store_true',
+                        help='Run without display and without LaTeX rendering of'
+                        + ' the plots; the plots can still be saved with -w')
+
+    parser.add_argument('-n', '--nproc', dest='nproc', type=int, default=4,
+                        help='Number of worker processes for several profile files'
+                        + ' and for the fits of the resolution map')
 
     parser.add_argument('-k', '--pixdim', dest='pixdim', type=myfloat, 
                         help='Specify pixel size in um')    
     
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true',
+                        help='Fit all the profiles of the input file at once, one'
+                        + ' profile per row ( text or .npy file ), without plots;'
+                        + ' the table of parameters and resolutions is written'
+                        + ' to the output file')
+
     parser.add_argument('-w', '--saveplots',dest='saveplots',
                         help='Save the plots in .png format in the specified path;'
                         + ' -e.g.: -w path/')
     
     args = parser.parse_args()
     
-    if args.filein is None:
+    if args.filein is None and args.image is None:
         parser.print_help()
         print("ERROR: Input file not specified!")
         sys.exit()
+
+    if args.map is True and args.image is None:
+        parser.print_help()
+        print("ERROR: The resolution map requires an input image!")
+        sys.exit()
+
+    if args.map is True and ( args.roi is not None or args.fileout is not None
+                              or args.prefilt is True ):
+        parser.print_help()
+        print("ERROR: Options -r, -o and -pr are not available for the resolution map!")
+        sys.exit()
     
     return args
 
@@ -128,10 +187,32 @@ def getArgs():
 ###########################################################
 ###########################################################
 
-def prefiltering( y ):
-    print('\n')
-    x1 = int( raw_input('Input extent x1 of the left step: ') )
-    x2 = int( raw_input('Input extent x2 of the right step: ') )
+##  Extents x1 , x2 of the plateaus y[:x1] and y[x2:] on the two sides
+##  of the edge: the edge is the run of samples around the peak of the
+##  smoothed derivative where the derivative exceeds the noise level,
+##  estimated robustly with the median absolute deviation
+
+def detect_plateaus( y , nsigma=3.0 ):
+    dy = np.abs( ndimage.uniform_filter1d( np.diff( y ) , 3 ) )
+    mad = np.median( np.abs( dy - np.median( dy ) ) )
+    threshold = np.median( dy ) + nsigma * 1.4826 * mad
+
+    index = np.arange( len( dy ) )
+    peak = np.argmax( dy )
+    below = dy < threshold
+    x1 = np.max( np.where( below & ( index < peak ) , index , -1 ) ) + 1
+    x2 = np.min( np.where( below & ( index > peak ) , index , len( dy ) ) ) + 1
+
+    return max( x1 , 1 ) , min( x2 , len( y ) - 1 )
+
+
+
+def prefiltering( y , verbose=True ):
+    x1 , x2 = detect_plateaus( y )
+
+    if verbose is True:
+        print('\nExtent x1 of the left step: ', x1)
+        print('Extent x2 of the right step: ', x2)
     
     mean_1 = np.mean( y[:x1] )
     y[:x1] = mean_1
@@ -199,13 +280,14 @@ def plot_function( curves , n , args ):
     rect = fig.patch
     rect.set_facecolor('white')
     axescolor  = '#f6f6f6'
-    ax = plt.subplot(111,axisbg=axescolor)  
+    ax = plt.subplot(111,facecolor=axescolor)  
     font0 = FontProperties()
     font1 = font0.copy()
     font1.set_size('large')
     font = font1.copy()
     font.set_family('serif')
-    rc('text',usetex=True)  
+    if args.headless is False:
+        rc('text',usetex=True)  
     gridLineWidth = 0.2
     ax.yaxis.grid(True, linewidth=gridLineWidth, linestyle='-', color='0.05')  
     fig.autofmt_xdate(bottom=0.18)
@@ -220,7 +302,6 @@ def plot_function( curves , n , args ):
     elif n == 2:
         plt.title('Line profile fitted with ERF', fontsize=12, fontweight='bold')
         plt.plot( x , y , linewidth=2 , color='blue' , label='Line profile' )
-        plt.hold( True )
         plt.plot( x , yfit , linewidth=3 , color='r' , label='Erf fit function' )
         plt.legend(loc='upper right', shadow=True)
     
@@ -276,7 +357,8 @@ def fit_line_profile( y , args ):
     elif args.func == 'sigmoid':
         yfit = sigmoid_func( param , x ) 
     
-    plot_function( [ y , yfit ] , 2 , args )
+    if args.headless is False or args.saveplots is not None:
+        plot_function( [ y , yfit ] , 2 , args )
 
     return param , yfit
 
@@ -320,10 +402,656 @@ def calc_resol( y , args ):
         resol *= args.pixdim 
         print('Resolution (um): ', resol )
 
+
+    ##  Calculate MTF of the fitted profile
+    freq , mtf = calc_mtf_batch( yfit )
+    mtf = mtf_points( freq , mtf )[0]
+    print_mtf( mtf , args )
+
+    return resol , mtf
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####       BATCH FITTING OF MANY EDGE PROFILES         ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Model and analytic Jacobian of each fitting function for the
+##  parameters p ( N , 4 ) of N profiles sampled on x ( L ):
+##  output arrays ( N , L ) and ( N , L , 4 )
+
+def error_func_jac( p , x ):
+    a , b , c , d = [ p[:,i,None] for i in range( 4 ) ]
+    u = ( x - c ) / d
+    erf = special.erf( u )
+    g = 2.0 / np.sqrt( np.pi ) * np.exp( -u * u ) * b / d
+
+    jac = np.empty( u.shape + ( 4 , ) , dtype=myfloat )
+    jac[:,:,0] = 1.0
+    jac[:,:,1] = erf
+    jac[:,:,2] = -g
+    jac[:,:,3] = -g * u
+
+    return a + b * erf , jac
+
+
+
+##  The sigmoid is fitted in the equivalent form a + b / ( 1 + exp( -d * ( x - x0 ) ) ),
+##  i.e. p = ( a , b , x0 , d ) with c = exp( d * x0 ): in the original
+##  parameters c and d are almost collinear and the iterations stall
+
+def sigmoid_center_jac( p , x ):
+    a , b , x0 , d = [ p[:,i,None] for i in range( 4 ) ]
+    s = 1.0 / ( 1 + np.exp( -d * ( x - x0 ) ) )
+    g = b * s * ( 1 - s )
+
+    jac = np.empty( s.shape + ( 4 , ) , dtype=myfloat )
+    jac[:,:,0] = 1.0
+    jac[:,:,1] = s
+    jac[:,:,2] = -g * d
+    jac[:,:,3] = g * ( x - x0 )
+
+    return a + b * s , jac
+
+
+
+##  Initial guess from the moments of the profiles: the two plateaus
+##  give offset and step, the first two moments of the derivative
+##  ( the line spread function ) give center and width of the edge;
+##  the third parameter is the center also for the sigmoid
+
+def initial_guess_batch( y , x , func ):
+    nplat = max( 1 , y.shape[1] // 10 )
+    left = np.mean( y[:,:nplat] , axis=1 )
+    right = np.mean( y[:,-nplat:] , axis=1 )
+
+    ##  Only the samples of the derivative around its peak and above a
+    ##  quarter of it are kept, as the noise would bias center and width;
+    ##  the peak is searched on the smoothed derivative
+    lsf = np.diff( y , axis=1 ) * np.sign( right - left )[:,None]
+    index = np.arange( lsf.shape[1] )
+    peak = np.argmax( ndimage.uniform_filter1d( lsf , 5 , axis=1 ) , axis=1 )[:,None]
+    below = lsf < 0.25 * np.max( lsf , axis=1 )[:,None]
+    x1 = np.max( np.where( below & ( index < peak ) , index , -1 ) , axis=1 )[:,None]
+    x2 = np.min( np.where( below & ( index > peak ) , index , lsf.shape[1] ) , axis=1 )[:,None]
+    lsf[( index <= x1 ) | ( index >= x2 ) | ( lsf < 0 )] = 0.0
+    norm = np.sum( lsf , axis=1 )
+    xm = 0.5 * ( x[1:] + x[:-1] )
+    empty = norm == 0
+    norm[empty] = 1.0
+    center = np.sum( lsf * xm , axis=1 ) / norm
+    center[empty] = xm[peak[empty,0]]
+    sigma = np.sqrt( np.sum( lsf * ( xm - center[:,None] )**2 , axis=1 ) / norm )
+
+    ##  A Gaussian cut at a quarter of its peak has 0.8 times its std
+    sigma = np.clip( sigma / 0.8 , 0.5 , None )
+
+    p0 = np.zeros( ( y.shape[0] , 4 ) , dtype=myfloat )
+    p0[:,2] = center
+
+    if func == 'erf':
+        p0[:,0] = 0.5 * ( left + right )
+        p0[:,1] = 0.5 * ( right - left )
+        p0[:,3] = np.sqrt( 2.0 ) * sigma
+    elif func == 'sigmoid':
+        p0[:,0] = left
+        p0[:,1] = right - left
+        p0[:,3] = np.pi / ( np.sqrt( 3.0 ) * sigma )
+
+    return p0
+
+
+
+##  Levenberg-Marquardt fit of all the N profiles y ( N , L ) at once:
+##  each iteration solves the N damped 4 X 4 normal equations together
+##  and every profile keeps its own damping factor; the optional
+##  "weight" ( N , L ) weighs the squared residuals, e.g. the number of
+##  pixels averaged in each sample, zero for the samples to ignore.
+##  Output: parameters ( N , 4 ), fitted profiles ( N , L ) and flags
+##  ( N ) of the successful fits; failed fits have NaN parameters and
+##  profiles
+
+def fit_profiles_batch( y , func='erf' , maxiter=200 , tol=1e-12 , weight=None ):
+    y = np.atleast_2d( y ).astype( myfloat )
+    x = np.arange( y.shape[1] ).astype( myfloat )
+
+    if weight is None:
+        weight = np.ones( y.shape , dtype=myfloat )
+    else:
+        weight = np.atleast_2d( weight ).astype( myfloat )
+
+    if func == 'erf':
+        model = error_func_jac
+    elif func == 'sigmoid':
+        model = sigmoid_center_jac
+    else:
+        sys.exit('\nERROR: Fitting function ' + func + ' not available!\n')
+
+    p = initial_guess_batch( y , x , func )
+    yfit , jac = model( p , x )
+    cost = np.sum( weight * ( yfit - y )**2 , axis=1 )
+    damp = np.full( y.shape[0] , 1e-3 )
+    active = np.ones( y.shape[0] , dtype=bool )
+
+    for it in range( maxiter ):
+        res = yfit[active] - y[active]
+        wjac = jac[active] * weight[active,:,None]
+        jtj = np.einsum( 'nli,nlj->nij' , wjac , jac[active] )
+        grad = np.einsum( 'nli,nl->ni' , wjac , res )
+
+        diag = np.einsum( 'nii->ni' , jtj )
+        lhs = jtj + ( damp[active,None] * diag + 1e-12 )[:,:,None] * np.eye( 4 )
+        try:
+            step = np.linalg.solve( lhs , -grad[:,:,None] )[:,:,0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum( 'nij,nj->ni' , np.linalg.pinv( lhs ) , grad )
+
+        p_new = p[active] + step
+        with np.errstate( over='ignore' , invalid='ignore' ):
+            yfit_new , jac_new = model( p_new , x )
+            cost_new = np.sum( weight[active] * ( yfit_new - y[active] )**2 , axis=1 )
+
+        ##  Accept the steps that reduce the cost, increase the damping
+        ##  of the others
+        better = cost_new < cost[active]
+        index = np.flatnonzero( active )
+        acc = index[better]
+        converged = np.zeros( y.shape[0] , dtype=bool )
+        converged[acc] = cost[acc] - cost_new[better] <= tol * ( cost[acc] + tol )
+
+        p[acc] = p_new[better]
+        yfit[acc] = yfit_new[better]
+        jac[acc] = jac_new[better]
+        cost[acc] = cost_new[better]
+        damp[acc] *= 0.1
+        damp[index[~better]] *= 10.0
+
+        active &= ~converged & ( damp < 1e10 )
+        if not np.any( active ):
+            break
+
+    success = np.all( np.isfinite( p ) , axis=1 ) & np.all( np.isfinite( yfit ) , axis=1 )
+
+    ##  Back to the parameters of "sigmoid_func": c = exp( d * x0 ) is out
+    ##  of the floating point range for sharp edges far from the origin,
+    ##  then the exponent is clipped and the fit flagged as failed
+    if func == 'sigmoid':
+        max_exponent = np.log( np.finfo( myfloat ).max )
+        exponent = p[:,3] * p[:,2]
+        success &= np.abs( exponent ) < max_exponent
+        p[:,2] = np.exp( np.clip( exponent , -max_exponent , max_exponent ) )
+
+    p[~success] = np.nan
+    yfit[~success] = np.nan
+
+    return p , yfit , success
+
+
+
+##  Resolution of many fitted profiles ( N , L ) with the definition of
+##  "calc_resol": range of the fitted profile divided by the extent of
+##  the samples where its derivative is non-zero
+
+def resol_batch( yfit , pixdim=None ):
+    dy = np.diff( yfit , axis=1 ) != 0
+    nonzero = np.any( dy , axis=1 )
+    x1 = np.argmax( dy , axis=1 ) - 1
+    x2 = dy.shape[1] - 1 - np.argmax( dy[:,::-1] , axis=1 ) + 1
+
+    resol = ( np.max( yfit , axis=1 ) - np.min( yfit , axis=1 ) ) / \
+            np.where( nonzero , x2 - x1 , 1 ).astype( myfloat )
+    resol[~nonzero] = np.nan
+
+    if pixdim is not None:
+        resol *= pixdim
+
     return resol
 
 
 
+##  Resolution , fitted parameters and MTF50 , MTF10 of the fitted
+##  profiles; "spacing" is the distance between the samples in pixels
+
+def calc_resol_batch( profiles , func='erf' , pixdim=None , spacing=1.0 , weight=None ):
+    param , yfit , success = fit_profiles_batch( profiles , func , weight=weight )
+    freq , mtf = calc_mtf_batch( yfit , spacing )
+    return resol_batch( yfit , pixdim ) , param , mtf_points( freq , mtf )
+
+
+
+##  Batch mode of the main: table with index , a , b , c , d ,
+##  resolution , MTF50 and MTF10 of each profile
+
+def write_resol_table( resol , param , mtf , args ):
+    table = np.column_stack( ( np.arange( len( resol ) ) , param , resol , mtf ) )
+    np.savetxt( args.fileout , table , fmt='%.8g' ,
+                header='index a b c d resol ( ' + args.func + ' ) mtf50 mtf10 ( cycles/pixel )' )
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####         MODULATION TRANSFER FUNCTION              ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  MTF of many edge spread functions ( N , L ) at once: the line spread
+##  functions are the derivatives of the ESF, a Hann window of length L
+##  centered on the centroid of each LSF suppresses the noise of the
+##  tails and a single rfft along the rows gives all the spectra, which
+##  are normalized at zero frequency.
+##  Output: frequencies in cycles/pixel and MTF ( N , L // 2 + 1 )
+
+def calc_mtf_batch( esf , spacing=1.0 ):
+    esf = np.atleast_2d( esf ).astype( myfloat )
+    lsf = np.gradient( esf , axis=1 )
+    x = np.arange( esf.shape[1] , dtype=myfloat )
+
+    weight = np.abs( lsf )
+    norm = np.sum( weight , axis=1 )
+    norm[norm == 0] = 1.0
+    center = np.sum( weight * x , axis=1 ) / norm
+
+    u = ( x - center[:,None] ) / esf.shape[1]
+    window = np.where( np.abs( u ) < 0.5 , 0.5 * ( 1 + np.cos( 2 * np.pi * u ) ) , 0.0 )
+
+    spectrum = np.abs( np.fft.rfft( lsf * window , axis=1 ) )
+    dc = spectrum[:,:1].copy()
+    dc[dc == 0] = 1.0
+
+    ##  Undo the low-pass of the central difference, sin( w ) / w,
+    ##  with the correction capped at 10 as in ISO 12233
+    response = np.sinc( 2 * np.fft.rfftfreq( esf.shape[1] ) )
+    correction = 1.0 / np.maximum( response , 0.1 )
+
+    freq = np.fft.rfftfreq( esf.shape[1] , d=spacing )
+
+    return freq , spectrum / dc * correction
+
+
+
+##  Frequencies where each MTF first drops below the given levels, with
+##  linear interpolation between the samples; NaN if it never does.
+##  Output: array ( N , number of levels ), e.g. MTF50 and MTF10
+
+def mtf_points( freq , mtf , levels=( 0.5 , 0.1 ) ):
+    points = np.full( ( mtf.shape[0] , len( levels ) ) , np.nan )
+    rows = np.arange( mtf.shape[0] )
+
+    for k , level in enumerate( levels ):
+        below = mtf < level
+        found = np.any( below , axis=1 )
+        i2 = np.maximum( np.argmax( below , axis=1 ) , 1 )
+        m1 = mtf[rows,i2-1];  m2 = mtf[rows,i2]
+        slope = np.where( m1 != m2 , ( level - m1 ) / np.where( m1 != m2 , m2 - m1 , 1.0 ) , 0.0 )
+        points[found,k] = ( freq[i2-1] + slope * ( freq[i2] - freq[i2-1] ) )[found]
+
+    return points
+
+
+
+def print_mtf( mtf , args ):
+    print('MTF50 (cycles/pixel): ', mtf[0], '   MTF10 (cycles/pixel): ', mtf[1])
+
+    if args.pixdim is not None:
+        print('MTF50 (lp/mm): ', mtf[0] * 1000.0 / args.pixdim,
+              '   MTF10 (lp/mm): ', mtf[1] * 1000.0 / args.pixdim)
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####    EDGE SPREAD FUNCTION FROM A SLANTED EDGE       ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Line of the edge in the image: centroid and principal axis of the
+##  pixels weighted by the squared gradient magnitude; the normal is
+##  oriented towards increasing grey values
+
+def detect_edge_line( image ):
+    grad0 = ndimage.sobel( image , 0 )
+    grad1 = ndimage.sobel( image , 1 )
+    weight = grad0 * grad0 + grad1 * grad1
+    weight[weight < 0.1 * np.max( weight )] = 0.0
+
+    coords = np.indices( image.shape ).reshape( 2 , -1 ).astype( myfloat )
+    weight = weight.reshape( -1 ) / np.sum( weight )
+    center = np.sum( coords * weight , axis=1 )
+    diff = coords - center[:,None]
+    cov = np.dot( diff * weight , diff.T )
+
+    eigval , eigvec = np.linalg.eigh( cov )
+    direction = eigvec[:,1]
+    normal = np.array( [ -direction[1] , direction[0] ] )
+
+    if np.sum( grad0 * normal[0] + grad1 * normal[1] ) < 0:
+        normal = -normal
+
+    return center , direction , normal
+
+
+
+##  Profiles with empty bins filled by linear interpolation between
+##  the occupied ones, row by row, only for the initial guess of the fit
+##  as the empty bins get zero weight; "sums" and "counts" ( N , L ) are
+##  the sums of the grey values and the numbers of pixels of each bin;
+##  profiles with less than 2 occupied bins are left at 0
+
+def fill_empty_bins( sums , counts ):
+    profiles = np.zeros( sums.shape , dtype=myfloat )
+    x = np.arange( sums.shape[1] )
+
+    for k in range( sums.shape[0] ):
+        full = counts[k] > 0
+        if np.count_nonzero( full ) >= 2:
+            profiles[k] = np.interp( x , x[full] , sums[k,full] / counts[k,full] )
+
+    return profiles
+
+
+
+##  Oversampled edge spread function, ISO 12233 style: the centers of
+##  all the pixels are projected onto the normal of the edge and their
+##  grey values averaged in bins of 1 / oversample pixels with bincount,
+##  so that no interpolation kernel blurs the ESF; the bins covered by
+##  less than half of the edge length are discarded.
+##  Output: distances from the edge in pixels , ESF and number of pixels
+##  of each bin, to be used as weights of the fit
+
+def edge_spread_function( image , oversample=4 ):
+    center , direction , normal = detect_edge_line( image )
+
+    coords = np.indices( image.shape ).reshape( 2 , -1 ).astype( myfloat )
+    dist = np.dot( normal , coords - center[:,None] )
+    bins = np.round( dist * oversample ).astype( int )
+    bins -= bins.min()
+
+    sums = np.bincount( bins , weights=image.reshape( -1 ) )
+    counts = np.bincount( bins )
+
+    ##  Coverage of each bin: number of pixels within one pixel along
+    ##  the normal, insensitive to the empty bins of edges with a small
+    ##  slant
+    coverage = np.convolve( counts , np.ones( oversample ) , mode='same' )
+    keep = np.flatnonzero( coverage >= 0.5 * np.max( coverage ) )
+    keep = slice( keep[0] , keep[-1] + 1 )
+
+    esf = fill_empty_bins( sums[None,keep] , counts[None,keep] )[0]
+    s = ( np.arange( len( counts ) )[keep] + np.round( dist.min() * oversample ) ) / myfloat( oversample )
+
+    return s , esf , counts[keep]
+
+
+
+##  Image mode of the main: ESF of the edge in the ROI, written as a
+##  two-column profile file, and its resolution; the ESF is sampled
+##  every 1 / oversample pixels, hence the resolution is rescaled to
+##  the pixel grid
+
+def calc_resol_image( args ):
+    image = io.readImage( args.image ).astype( myfloat )
+    print('\nReading image:\n', args.image)
+    print('Image shape: ', image.shape)
+
+    if args.roi is not None:
+        roi = args.roi.split(',')
+        p0 = [int(roi[0].split(':')[1]),int(roi[0].split(':')[0])]
+        p1 = [int(roi[1].split(':')[1]),int(roi[1].split(':')[0])]
+        print('Cropping rectangular ROI with vertices:  ( ', \
+                p0[0],' , ', p0[1], ')   ( ', p1[0],' , ',p1[1], ')')
+        image = proc.crop_image( image , p0 , p1 )
+
+    dist , esf , counts = edge_spread_function( image , args.oversample )
+    print('\nEdge spread function with oversampling ', args.oversample,
+          ':  ', len( esf ), ' samples')
+
+    fileout = args.image[:len(args.image)-4] + '_esf.txt'
+    np.savetxt( fileout , np.column_stack( ( dist , esf ) ) )
+    print('Written edge profile:\n', fileout)
+
+    resol , param , mtf = calc_resol_batch( esf , args.func , spacing=1.0/args.oversample ,
+                                            weight=counts )
+    resol = resol[0] * args.oversample
+
+    print('a = ', param[0,0],'  b = ', param[0,1],'  c = ', param[0,2],'  d = ', param[0,3])
+    print('\nResolution (pixels): ', resol )
+
+    if args.pixdim is not None:
+        resol *= args.pixdim 
+        print('Resolution (um): ', resol )
+
+    print_mtf( mtf[0] , args )
+
+    return resol , mtf[0]
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####      RESOLUTION MAP OVER ALL THE EDGES            ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Number of profiles extracted and fitted by each task of the pool
+map_chunk = 512
+
+##  Image of the resolution map, set once in each worker of the pool
+map_image = None
+
+
+
+##  Edge segments: pixels whose Sobel magnitude exceeds the noise level,
+##  estimated robustly with the median absolute deviation, grouped in
+##  connected edges and split by a grid of size "segment".
+##  Output: map of the segment labels ( 0 = background ) and, for each
+##  segment, gradient-weighted center, unit normal towards increasing
+##  grey values and number of pixels
+
+def detect_edge_segments( image , segment , nsigma=5.0 ):
+    grad0 = ndimage.sobel( image , 0 )
+    grad1 = ndimage.sobel( image , 1 )
+    mag = np.sqrt( grad0 * grad0 + grad1 * grad1 )
+
+    mad = np.median( np.abs( mag - np.median( mag ) ) )
+    mask = mag > np.median( mag ) + nsigma * 1.4826 * mad
+    edges , nedges = ndimage.label( mask )
+
+    rows , cols = np.indices( image.shape )
+    nblocks1 = image.shape[1] // segment + 1
+    block = ( rows // segment ) * nblocks1 + cols // segment
+    key = np.where( mask , edges * ( block.max() + 1 ) + block , 0 )
+    codes , labels = np.unique( key , return_inverse=True )
+    labels = labels.reshape( image.shape )
+    index = np.arange( 1 , len( codes ) )
+
+    weight = mag * mag
+    wsum = ndimage.sum( weight , labels , index )
+    center = np.column_stack( ( ndimage.sum( weight * rows , labels , index ) / wsum ,
+                                ndimage.sum( weight * cols , labels , index ) / wsum ) )
+    normal = np.column_stack( ( ndimage.sum( grad0 , labels , index ) ,
+                                ndimage.sum( grad1 , labels , index ) ) )
+    normal /= np.linalg.norm( normal , axis=1 )[:,None]
+    npix = ndimage.sum( mask , labels , index ).astype( int )
+
+    return labels , center , normal , npix
+
+
+
+##  Profiles across all the segments at once, as for the ESF of a
+##  single edge: the pixels of a box around each segment within "half"
+##  pixels along the normal and "width" pixels along the edge are
+##  projected onto the normal and binned every 1 / oversample pixels,
+##  2 * half * oversample + 1 bins, with one bincount for all segments.
+##  Output: profiles and numbers of pixels of the bins ( nsegments , L )
+
+def edge_profiles( image , center , normal , half , oversample=4 , width=8 ):
+    nbins = 2 * half * oversample + 1
+    radius = int( np.ceil( np.hypot( half , width ) ) ) + 1
+    offset = np.indices( ( 2 * radius + 1 , 2 * radius + 1 ) ).reshape( 2 , -1 ) - radius
+
+    pixels = np.round( center ).astype( int )[:,:,None] + offset[None,:,:]
+    diff = pixels - center[:,:,None]
+    dist = normal[:,0,None] * diff[:,0] + normal[:,1,None] * diff[:,1]
+    along = normal[:,0,None] * diff[:,1] - normal[:,1,None] * diff[:,0]
+
+    bins = np.round( dist * oversample ).astype( int ) + half * oversample
+    select = ( pixels[:,0] >= 0 ) & ( pixels[:,0] < image.shape[0] ) & \
+             ( pixels[:,1] >= 0 ) & ( pixels[:,1] < image.shape[1] ) & \
+             ( bins >= 0 ) & ( bins < nbins ) & ( np.abs( along ) <= width )
+
+    index = ( np.arange( len( center ) )[:,None] * nbins + bins )[select]
+    values = image[pixels[:,0][select],pixels[:,1][select]]
+    sums = np.bincount( index , weights=values , minlength=len( center ) * nbins )
+    counts = np.bincount( index , minlength=len( center ) * nbins )
+
+    sums = sums.reshape( -1 , nbins );  counts = counts.reshape( -1 , nbins )
+
+    return fill_empty_bins( sums , counts ) , counts
+
+
+
+def init_map_worker( image ):
+    global map_image
+    map_image = image
+
+
+
+##  Profiles of a chunk of segments extracted and fitted in the worker,
+##  so that only centers and normals travel to the pool and only the
+##  temporary arrays of "map_chunk" segments are built at once
+
+def fit_profiles_chunk( task ):
+    center , normal , half , oversample , width , func = task
+    profiles , counts = edge_profiles( map_image , center , normal , half , oversample , width )
+    return calc_resol_batch( profiles , func , spacing=1.0 / oversample , weight=counts )
+
+
+
+##  Resolution of all the segments: the profiles are extracted and
+##  fitted by the batch EPF in chunks of "map_chunk" segments across a
+##  pool of workers, which receive the image once
+
+def calc_resol_map( image , args ):
+    labels , center , normal , npix = detect_edge_segments( image , args.segment )
+
+    ##  Segments too small for a reliable edge direction are discarded
+    keep = npix >= max( 2 , args.segment // 2 )
+    print('\nEdge segments detected: ', len( npix ), '   kept: ', np.count_nonzero( keep ))
+
+    ##  No edge segment: empty map and table with the same 13 columns
+    if not np.any( keep ):
+        print('\nWarning: no edge segment found, the resolution map is empty')
+        return np.zeros( image.shape , dtype=myfloat ) , np.zeros( ( 0 , 13 ) , dtype=myfloat )
+
+    center_keep = center[keep];  normal_keep = normal[keep]
+    tasks = [ ( center_keep[i:i+map_chunk] , normal_keep[i:i+map_chunk] , args.segment ,
+                args.oversample , args.segment // 2 , args.func )
+              for i in range( 0 , len( center_keep ) , map_chunk ) ]
+    pool = mp.Pool( args.nproc , initializer=init_map_worker , initargs=( image , ) )
+    results = pool.map( fit_profiles_chunk , tasks )
+    pool.close()
+    pool.join()
+
+    resol = np.concatenate( [ r[0] for r in results ] ) * args.oversample
+    param = np.concatenate( [ r[1] for r in results ] , axis=0 )
+    mtf = np.concatenate( [ r[2] for r in results ] , axis=0 )
+    if args.pixdim is not None:
+        resol *= args.pixdim
+
+    ##  Sparse map: resolution on the pixels of each segment, 0 elsewhere
+    values = np.zeros( len( npix ) + 1 , dtype=myfloat )
+    values[1:][keep] = resol
+    resol_map = values[labels]
+
+    table = np.column_stack( ( np.flatnonzero( keep ) + 1 , center[keep] , normal[keep] ,
+                               npix[keep] , param , resol , mtf ) )
+
+    return resol_map , table
+
+
+
+def write_resol_map( args ):
+    image = io.readImage( args.image ).astype( myfloat )
+    print('\nReading image:\n', args.image)
+    print('Image shape: ', image.shape)
+
+    resol_map , table = calc_resol_map( image , args )
+    resol = table[:,-3]
+    if len( resol ) > 0:
+        print('Resolution -- median: ', np.nanmedian( resol ),
+              '  min: ', np.nanmin( resol ), '  max: ', np.nanmax( resol ))
+        print('MTF50 -- median: ', np.nanmedian( table[:,-2] ), ' cycles/pixel')
+
+    base = args.image[:len(args.image)-4]
+    io.writeImage( base + '_resol_map.tif' , resol_map )
+    np.savetxt( base + '_resol_segments.txt' , table , fmt='%.8g' ,
+                header='label row col normal_row normal_col npix a b c d resol ( '
+                + args.func + ' ) mtf50 mtf10 ( cycles/pixel )' )
+    print('Written map and table:\n', base + '_resol_map.tif\n', base + '_resol_segments.txt')
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####          POOL OF WORKERS OVER PROFILE FILES       ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Resolution of the profile in one file, without plots
+
+def resol_profile_file( task ):
+    filein , func , prefilt , pixdim = task
+    y = np.loadtxt( filein )[:,1].astype( myfloat )
+
+    if prefilt is True:
+        y = prefiltering( y , verbose=False )
+
+    resol , param , mtf = calc_resol_batch( y , func , pixdim )
+
+    return resol[0] , mtf[0,0] , mtf[0,1]
+
+
+
+def calc_resol_files( files , args ):
+    tasks = [ ( filein , args.func , args.prefilt , args.pixdim ) for filein in files ]
+
+    pool = mp.Pool( args.nproc )
+    results = pool.map( resol_profile_file , tasks )
+    pool.close()
+    pool.join()
+
+    return results
+
+
+
+def write_resol_files( files , results , args ):
+    fp = open( args.fileout , 'w' )
+    fp.write('# profile file , resolution ( ' + args.func + ' ) , MTF50 , MTF10 ( cycles/pixel )')
+    for filein , r in zip( files , results ):
+        fp.write('\n' + filein + ' ' + ' '.join( [ str( v ) for v in r ] ) )
+    fp.write('\n')
+    fp.close()
+
+
+
 
 ###########################################################
 ###########################################################
@@ -333,7 +1061,7 @@ def calc_resol( y , args ):
 ###########################################################
 ########################################################### 
 
-def write_log_file( resol , args ):
+def write_log_file( resol , args , mtf=None ):
     fp = open( args.fileout , 'w' ) 
 
 
@@ -356,7 +1084,13 @@ def write_log_file( resol , args ):
 
 
     ##  Print oracle image file
-    fp.write('\n\nReading line profile file:\n' + args.filein)
+    if args.image is not None:
+        fp.write('\n\nReading image:\n' + args.image)
+        if args.roi is not None:
+            fp.write('\nROI: ' + args.roi)
+        fp.write('\nEdge spread function oversampled by ' + str( args.oversample ))
+    else:
+        fp.write('\n\nReading line profile file:\n' + args.filein)
 
 
     
@@ -371,6 +1105,10 @@ def write_log_file( resol , args ):
     else:
         fp.write('\nRESOLUTION = ' + str( resol ) + ' um' )    
 
+    if mtf is not None:
+        fp.write('\nMTF50 = ' + str( mtf[0] ) + ' cycles/pixel' )
+        fp.write('\nMTF10 = ' + str( mtf[1] ) + ' cycles/pixel' )
+
     fp.write('\n')
 
 
@@ -403,6 +1141,79 @@ def main():
     ##  GET INPUT ARGUMENTS
     args = getArgs()
 
+    if args.headless is True:
+        plt.switch_backend('Agg')
+        args.plot = False
+
+
+
+    ##  MAP MODE: RESOLUTION OF ALL THE EDGE SEGMENTS OF THE IMAGE
+    if args.map is True:
+        write_resol_map( args )
+        print('\n')
+        return
+
+
+
+    ##  IMAGE MODE: EDGE PROFILE EXTRACTED FROM THE IMAGE
+    if args.image is not None:
+        resol , mtf = calc_resol_image( args )
+
+        if args.fileout is not None:
+            write_log_file( resol , args , mtf )
+
+        print('\n')
+        return
+
+
+
+    ##  BATCH MODE: ALL THE PROFILES OF THE FILE FITTED AT ONCE
+    if args.batch is True:
+        if args.filein.endswith('.npy'):
+            profiles = np.load( args.filein )
+        else:
+            profiles = np.loadtxt( args.filein , ndmin=2 )
+        print('\nInput file of profiles:\n', args.filein)
+        print('Number of profiles: ', profiles.shape[0], '   length: ', profiles.shape[1])
+        print('\nSelected fitting function: ', args.func)
+
+        resol , param , mtf = calc_resol_batch( profiles , args.func , args.pixdim )
+
+        nfailed = np.count_nonzero( np.isnan( param[:,0] ) )
+        if nfailed > 0:
+            print('\nWarning: ', nfailed, ' fits failed, their parameters and resolution are NaN')
+
+        print('\nResolution -- median: ', np.nanmedian( resol ),
+              '  min: ', np.nanmin( resol ), '  max: ', np.nanmax( resol ))
+        print('MTF50 -- median: ', np.nanmedian( mtf[:,0] ), ' cycles/pixel')
+
+        if args.fileout is not None:
+            write_resol_table( resol , param , mtf , args )
+            print('Written table:\n', args.fileout)
+
+        print('\n')
+        return
+
+
+
+    ##  SEVERAL PROFILE FILES: ONE TASK PER FILE FOR A POOL OF WORKERS
+    if args.filein.find( ':' ) != -1:
+        files = args.filein.split(':')
+        print('\nNumber of profile files: ', len( files ))
+        print('Selected fitting function: ', args.func)
+
+        results = calc_resol_files( files , args )
+
+        for filein , r in zip( files , results ):
+            print(filein, '   resolution: ', r[0], '   MTF50: ', r[1], '   MTF10: ', r[2])
+
+        if args.fileout is not None:
+            write_resol_files( files , results , args )
+            print('Written table:\n', args.fileout)
+
+        print('\n')
+        return
+
 
 
     ##  READ LINE PROFILE FILE
@@ -418,13 +1229,13 @@ def main():
 
 
     ##  CALCULATE RESOLUTION WITH ERROR FUNCTION FITTING METHOD
-    resol = calc_resol( line_profile[:,1] , args )
+    resol , mtf = calc_resol( line_profile[:,1] , args )
 
 
 
     ##  WRITE OUTPUT LOG FILE
     if args.fileout is not None:
-        write_log_file( resol , args )
+        write_log_file( resol , args , mtf )
 
 
     print('\n')
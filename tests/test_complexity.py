@@ -1,8 +1,12 @@
 from __future__ import division , print_function
 import os
+import sys
+import tempfile
+import numpy as np
 
 command1 = 'python calc_complexity.py -Di ../data/ -i phantom_01.tif -p'
 command2 = 'python calc_complexity.py -Di ../data/ -i phantom_02.tif -p'
+command3 = 'python calc_complexity.py -Di ../data/ -i phantom_01.tif -b 32 -z zlib -n 2'
 
 os.chdir( '../metrics/' )
 
@@ -14,4 +18,32 @@ os.system( command1 )
 print( command2 )
 os.system( command2 )
 
+print( command3 )
+os.system( command3 )
 
+
+##  Stack of slices built from phantom_01 and its flipped copies
+sys.path.append( '../common/' )
+import my_image_io as io
+
+tmpdir = tempfile.mkdtemp()
+if os.path.isfile( '../data/phantom_01.tif' ):
+    image = io.readImage( '../data/phantom_01.tif' )
+    io.writeImage( os.path.join( tmpdir , 'phantom_01_stack.npy' ) ,
+                   np.array( [ image , image[::-1,:] , image[:,::-1] ] ) )
+command4 = 'python calc_complexity.py -Di ' + tmpdir + '/ -i phantom_01_stack.npy -s -n 2'
+
+print( command4 )
+os.system( command4 )
+
+
+##  Flat slice, e.g. blank slice of a stack: finite ratios, no division by 0
+sys.path.append( os.getcwd() )
+import calc_complexity
+
+print( '\nTEST: Compression ratios of a flat slice, expected finite\n' )
+with np.errstate( all='raise' ):
+    ratios = calc_complexity.compression_ratios( ( np.full( ( 64 , 64 ) , 7.0 ) , 75 ) )
+print( 'Ratios: ' , ratios )
+assert np.all( np.isfinite( ratios ) )
+assert not np.any( calc_complexity.quantize_uint8( np.full( ( 8 , 8 ) , 3 , dtype=np.uint16 ) ) )
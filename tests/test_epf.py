@@ -1,12 +1,118 @@
 from __future__ import division , print_function
 import os
+import sys
+import tempfile
+import numpy as np
+import scipy.optimize
 
-command = 'python -W ignore edge_profile_fitting.py -i ../data/phantom_01_distorted_line_profile.txt -p'
+tmpdir = tempfile.mkdtemp()
+
+command1 = 'python -W ignore edge_profile_fitting.py -i ../data/phantom_01_distorted_line_profile.txt -p'
+command2 = 'python -W ignore edge_profile_fitting.py -i ' + os.path.join( tmpdir , 'phantom_01_distorted_line_profiles.txt' ) \
+           + ' -b -o ' + os.path.join( tmpdir , 'phantom_01_distorted_line_profiles_resol.txt' )
+command3 = 'python -W ignore edge_profile_fitting.py -im ../data/phantom_01_distorted.tif -s 4 -o ' \
+           + os.path.join( tmpdir , 'phantom_01_distorted_esf_resol.txt' )
+command4 = 'python -W ignore edge_profile_fitting.py -i ../data/phantom_01_distorted_line_profile.txt -hl -w ' \
+           + os.path.join( tmpdir , 'phantom_01_distorted_line_profile_fit.eps' )
+command5 = 'python -W ignore edge_profile_fitting.py -im ../data/phantom_01_distorted.tif -m -g 16 -hl -n 2'
 
 os.chdir( '../metrics/' )
 
 print( '\nTEST: Measure spatial resolution through Edge Profile Fitting (EPF)\n' )
-print( command )
-os.system( command )
 
+print( command1 )
+os.system( command1 )
+
+
+##  Batch of profiles: shifted windows of the line profile, one per row
+if os.path.isfile( '../data/phantom_01_distorted_line_profile.txt' ):
+    profile = np.loadtxt( '../data/phantom_01_distorted_line_profile.txt' )[:,1]
+    length = len( profile ) - 8
+    np.savetxt( os.path.join( tmpdir , 'phantom_01_distorted_line_profiles.txt' ) ,
+                np.array( [ profile[shift:shift+length] for shift in range( 0 , 9 , 2 ) ] ) )
+
+print( command2 )
+os.system( command2 )
+
+print( command3 )
+os.system( command3 )
+
+print( command4 )
+os.system( command4 )
+
+print( command5 )
+os.system( command5 )
+
+
+sys.path.append( os.getcwd() )
+import edge_profile_fitting as epf
+
+print( '\nTEST: Batch fit of noisy edges, expected to reach the cost of leastsq\n' )
+np.random.seed( 0 )
+x = np.arange( 64 , dtype=np.float64 )
+center = 30 + 0.7 * np.arange( 8 );  width = 1.5 + 0.3 * np.arange( 8 )
+param_erf = np.column_stack( ( 10 + np.arange( 8 ) , 5 + 0.5 * np.arange( 8 ) , center , width ) )
+param_sigmoid = param_erf.copy()
+param_sigmoid[:,3] = 1.0 / width
+param_sigmoid[:,2] = np.exp( center / width )
+
+for func , param_true , model , model_fit in ( ( 'erf' , param_erf , epf.error_func , epf.error_func_fit ) ,
+        ( 'sigmoid' , param_sigmoid , epf.sigmoid_func , epf.sigmoid_func_fit ) ):
+    y = np.array( [ model( p , x ) for p in param_true ] ) + 0.05 * np.random.randn( 8 , 64 )
+    param , yfit , success = epf.fit_profiles_batch( y , func )
+    assert np.all( success )
+    for k in range( 8 ):
+        param_lsq , flag = scipy.optimize.leastsq( model_fit , param_true[k] , args=( x , y[k] ) )
+        cost_batch = np.sum( ( yfit[k] - y[k] )**2 )
+        cost_lsq = np.sum( model_fit( param_lsq , x , y[k] )**2 )
+        assert cost_batch <= cost_lsq * ( 1 + 1e-6 )
+    print( func , ':  batch cost equal to the leastsq cost for all the profiles' )
+
+print( '\nTEST: Sharp sigmoid edge far from the origin, expected flagged as failed\n' )
+y = 10 + 5.0 / ( 1 + np.exp( -5.0 * np.clip( np.arange( 400.0 ) - 200 , -100 , 100 ) ) )
+with np.errstate( over='raise' ):
+    param , yfit , success = epf.fit_profiles_batch( y , 'sigmoid' )
+print( 'Parameters: ' , param[0] , '   success: ' , success[0] )
+assert not success[0] and np.all( np.isnan( param ) ) and np.all( np.isnan( yfit ) )
+
+print( '\nTEST: Slanted-edge ESF of a synthetic erf edge, expected to give its width\n' )
+from scipy import special
+rows , cols = np.indices( ( 128 , 128 ) )
+for angle in ( 0.0 , 5.0 , 30.0 ):
+    theta = np.deg2rad( angle )
+    dist = ( rows - 64 ) * np.cos( theta ) + ( cols - 64 ) * np.sin( theta )
+    image = 100 + 50 * special.erf( dist / ( np.sqrt( 2 ) * 1.5 ) )
+    s , esf , counts = epf.edge_spread_function( image , 4 )
+    resol , param , mtf = epf.calc_resol_batch( esf , 'erf' , spacing=0.25 , weight=counts )
+    width = param[0,3] / 4.0
+    print( 'Angle ' , angle , ':  fitted erf width ' , width , '   expected ' , np.sqrt( 2 ) * 1.5 )
+    assert np.abs( width - np.sqrt( 2 ) * 1.5 ) < 0.01 * np.sqrt( 2 ) * 1.5
+    assert np.abs( s[np.argmin( np.abs( esf - 100 ) )] ) <= 0.25
+
+print( '\nTEST: Resolution map of a synthetic disk, expected independent of the chunks of the pool\n' )
+import types
+image = 100 + 50 * special.erf( ( np.hypot( rows - 64 , cols - 64 ) - 40 ) / ( np.sqrt( 2 ) * 1.5 ) )
+args = types.SimpleNamespace( segment=16 , oversample=4 , func='erf' , nproc=2 , pixdim=None )
+resol_map , table = epf.calc_resol_map( image , args )
+map_chunk = epf.map_chunk
+epf.map_chunk = 5
+resol_map_chunks , table_chunks = epf.calc_resol_map( image , args )
+epf.map_chunk = map_chunk
+print( 'Segments: ' , table.shape[0] , '   median resolution: ' , np.median( table[:,-3] ) )
+assert table.shape[0] > 5
+assert np.array_equal( table , table_chunks , equal_nan=True )
+assert np.array_equal( resol_map , resol_map_chunks )
 
+print( '\nTEST: MTF of erf edges, expected equal to the analytic Gaussian MTF\n' )
+for spacing , length in ( ( 1.0 , 128 ) , ( 0.25 , 512 ) ):
+    for sigma in ( 0.8 , 1.5 , 3.0 ):
+        x = np.arange( length ) * spacing
+        esf = epf.error_func( [ 0.0 , 1.0 , x[length//2] + 0.3 , np.sqrt( 2 ) * sigma ] , x )
+        freq , mtf = epf.calc_mtf_batch( esf , spacing )
+        mtf_exact = np.exp( -2 * np.pi**2 * sigma**2 * freq**2 )
+        points = epf.mtf_points( freq , mtf )[0]
+        points_exact = np.sqrt( np.log( [ 2.0 , 10.0 ] ) / ( 2 * np.pi**2 * sigma**2 ) )
+        print( 'Spacing ' , spacing , '  sigma ' , sigma , ':  MTF50 , MTF10 ' , points ,
+               '   expected ' , points_exact )
+        assert np.all( np.abs( points - points_exact ) < 0.02 * points_exact )
+        assert np.max( np.abs( mtf[0] - mtf_exact )[mtf_exact > 0.05] ) < 0.03
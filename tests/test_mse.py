@@ -1,12 +1,135 @@
 from __future__ import division , print_function
 import os
+import sys
+import numpy as np
 
-command = 'python calc_mse.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -s -p'
+command1 = 'python calc_mse.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -s -p'
+command2 = 'python calc_mse.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -m 15'
 
 os.chdir( '../metrics/' )
 
 print( '\nTEST: Mean Squared Error (MSE) and Peak Signal to Noise Ratio (PSNR)\n' )
-print( command )
-os.system( command )
 
+print( command1 )
+os.system( command1 )
 
+print( command2 )
+os.system( command2 )
+
+
+sys.path.append( os.getcwd() )
+import calc_mse
+
+oracle = np.random.randint( 0 , 2**16 , ( 256 , 192 ) ).astype( np.uint16 )
+image = np.clip( oracle + np.random.randint( -500 , 500 , oracle.shape ) , 1 , 2**16 - 1 ).astype( np.uint16 )
+
+print( '\nTEST: Figures of merit of two merged halves, expected equal to the whole image\n' )
+whole = calc_mse.ErrorStats().update( oracle , image ).metrics()
+stats = calc_mse.ErrorStats().update( oracle[:100] , image[:100] )
+stats.merge( calc_mse.ErrorStats().update( oracle[100:] , image[100:] ) )
+halves = stats.metrics()
+print( 'Whole image: ' , whole , '\nMerged halves: ' , halves )
+assert np.allclose( whole , halves , rtol=1e-12 , atol=0 )
+
+print( '\nTEST: Figures of merit of 16-bit images, expected equal in int64 and float\n' )
+native = calc_mse.ErrorStats().update( oracle , image ).metrics()
+floating = calc_mse.ErrorStats().update( oracle.astype( np.float64 ) , image.astype( np.float64 ) ).metrics()
+print( 'int64: ' , native , '\nfloat: ' , floating )
+assert isinstance( calc_mse.ErrorStats().update( oracle , image ).sum_d2 , int )
+assert np.allclose( native , floating , rtol=1e-12 , atol=0 )
+
+print( '\nTEST: Figures of merit of a stack, expected equal to those of each image\n' )
+stack = np.array( [ image , image[::-1,:] , oracle ] )
+stack[2,0,0] += 1
+batch = calc_mse.calc_metrics_batch( oracle , stack , maxerr=True )
+for k in range( stack.shape[0] ):
+    single = calc_mse.ErrorStats().update( oracle , stack[k] ).metrics()
+    print( 'Image ' , k , '   batch: ' , batch[k] , '   single: ' , single )
+    assert np.allclose( batch[k] , single , rtol=1e-12 , atol=0 )
+assert calc_mse.calc_rmse( oracle , stack[2] ) == np.sqrt( 1.0 / oracle.size )
+
+print( '\nTEST: Errors of 8-bit images, expected exact and without wrap-around\n' )
+oracle8 = np.zeros( ( 300 , 300 ) , dtype=np.uint8 )
+image8 = np.full( ( 300 , 300 ) , 255 , dtype=np.uint8 )
+image8[0,0] = 0
+stats = calc_mse.ErrorStats().update( oracle8 , image8 )
+print( 'sum ( r - t )^2 = ' , stats.sum_d2 , '   sum | r - t | = ' , stats.sum_ad , '   max = ' , stats.max_ad )
+assert stats.sum_d2 == ( oracle8.size - 1 ) * 255**2
+assert stats.sum_ad == ( oracle8.size - 1 ) * 255
+assert stats.max_ad == 255
+
+print( '\nTEST: Cache of the ROI masks, expected to be reused until the file or the shape change\n' )
+import tempfile
+tmpdir = tempfile.mkdtemp()
+roi_file = os.path.join( tmpdir , 'roi.txt' )
+np.savetxt( roi_file , [ [ 1 , 2 ] , [ 3 , 4 ] ] , fmt='%d' )
+calc_mse.roi_cache.clear()
+mask1 = calc_mse.load_roi_mask( roi_file , ( 8 , 8 ) )
+mask2 = calc_mse.load_roi_mask( roi_file , ( 8 , 8 ) )
+assert len( calc_mse.roi_cache ) == 1
+assert np.array_equal( mask1 , mask2 ) and np.count_nonzero( mask1 ) == 2 and mask1[3,4]
+
+np.savetxt( roi_file , [ [ 5 , 6 ] ] , fmt='%d' )
+mtime = os.path.getmtime( roi_file ) + 10
+os.utime( roi_file , ( mtime , mtime ) )
+mask3 = calc_mse.load_roi_mask( roi_file , ( 8 , 8 ) )
+assert len( calc_mse.roi_cache ) == 2
+assert np.count_nonzero( mask3 ) == 1 and mask3[5,6]
+
+mask4 = calc_mse.load_roi_mask( roi_file , ( 16 , 8 ) )
+assert len( calc_mse.roi_cache ) == 3
+assert mask4.shape == ( 16 , 8 ) and np.count_nonzero( mask4 ) == 1 and mask4[5,6]
+print( 'Cached masks: ' , len( calc_mse.roi_cache ) )
+
+print( '\nTEST: Maps of local errors, expected equal to a brute-force window\n' )
+oracle_small = np.random.rand( 20 , 17 ) * 100
+image_small = oracle_small + np.random.randn( 20 , 17 )
+for window in ( 4 , 5 ):
+    map_rmse , map_psnr , map_mae = calc_mse.calc_local_error_maps( oracle_small , image_small ,
+                                                                    window , tile_rows=6 )
+    hl = ( window - 1 ) // 2;  hr = window - 1 - hl
+    peak = np.max( oracle_small )
+    for i in range( 20 ):
+        for j in range( 17 ):
+            d = ( oracle_small - image_small )[max(0,i-hl):i+hr+1,max(0,j-hl):j+hr+1]
+            assert np.abs( map_rmse[i,j] - np.sqrt( np.mean( d * d ) ) ) < 1e-9
+            assert np.abs( map_mae[i,j] - np.mean( np.abs( d ) ) ) < 1e-9
+            assert np.abs( map_psnr[i,j] - 10 * np.log10( peak**2 / np.mean( d * d ) ) ) < 1e-6
+    print( 'Window ' , window , ':  maps equal to the brute force' )
+
+print( '\nTEST: Slice by slice analysis along each axis of a memory-mapped volume,'
+       + ' expected equal to the figures of each slice\n' )
+volume_file1 = os.path.join( tmpdir , 'volume1.npy' )
+volume_file2 = os.path.join( tmpdir , 'volume2.npy' )
+np.save( volume_file1 , np.random.randint( 1 , 2**16 , ( 7 , 20 , 30 ) ).astype( np.uint16 ) )
+np.save( volume_file2 , np.random.randint( 1 , 2**16 , ( 7 , 20 , 30 ) ).astype( np.uint16 ) )
+volume1 = np.load( volume_file1 , mmap_mode='r' )
+volume2 = np.load( volume_file2 , mmap_mode='r' )
+chunk_size = calc_mse.chunk_size
+calc_mse.chunk_size = 1500
+for axis in range( 3 ):
+    for v1 , v2 in ( ( volume1 , volume2 ) , ( volume1.astype( np.float64 ) , volume2.astype( np.float64 ) ) ):
+        results_slices , results_global = calc_mse.calc_metrics_slices( v1 , v2 , axis )
+        for k in range( v1.shape[axis] ):
+            single = calc_mse.ErrorStats().update( np.take( v1 , k , axis ) , np.take( v2 , k , axis ) ).metrics()
+            assert np.allclose( results_slices[k] , single , rtol=1e-12 , atol=0 )
+        whole = calc_mse.ErrorStats().update( v1 , v2 ).metrics()
+        assert np.allclose( results_global , whole , rtol=1e-12 , atol=0 )
+    print( 'Axis ' , axis , ':  ' , results_slices.shape[0] , ' slices equal to the single figures' )
+calc_mse.chunk_size = chunk_size
+
+print( '\nTEST: Quantiles of the error sketch, expected within its relative accuracy\n' )
+errors = np.abs( np.random.standard_cauchy( 200000 ) )
+errors[:1000] = 0
+sketch1 = calc_mse.ErrorSketch( 0.01 )
+sketch2 = calc_mse.ErrorSketch( 0.01 )
+for k , part in enumerate( np.array_split( errors , 7 ) ):
+    ( sketch1 if k % 2 == 0 else sketch2 ).update( part )
+sketch1.merge( sketch2 )
+exact = np.sort( errors )
+for q in ( 0.001 , 0.01 , 0.1 , 0.5 , 0.9 , 0.99 , 0.999 , 1.0 ):
+    value = exact[int( q * ( errors.size - 1 ) )]
+    estimate = sketch1.quantile( q )
+    print( 'q = ' , q , '   exact: ' , value , '   sketch: ' , estimate )
+    assert np.abs( estimate - value ) <= 0.01 * value
+assert sketch1.count == errors.size and sketch1.nzero == 1000
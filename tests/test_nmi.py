@@ -1,12 +1,47 @@
 from __future__ import division , print_function
 import os
+import sys
+import numpy as np
 
-command = 'python calc_nmi.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -s -p'
+command1 = 'python calc_nmi.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -s -p'
+command2 = 'python calc_nmi.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -v -n 2'
+command3 = 'python calc_nmi.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -w 32,64,128,256 -m all'
+command4 = 'python calc_nmi.py -i1 ../data/phantom_02.tif -i2 ../data/phantom_02_distorted.tif -l 15 -n 2'
 
 os.chdir( '../metrics/' )
 
 print( '\nTEST: Compute Normalized Mutual Information (NMI)\n' )
-print( command )
-os.system( command )
 
+print( command1 )
+os.system( command1 )
 
+print( command2 )
+os.system( command2 )
+
+print( command3 )
+os.system( command3 )
+
+print( command4 )
+os.system( command4 )
+
+
+sys.path.append( os.getcwd() )
+import calc_nmi
+
+print( '\nTEST: NMI of independent 16-bit images, expected close to 0 with a dense'
+       + ' joint histogram and far from the saturation at 2 with a sparse one\n' )
+image1 = np.random.randint( 0 , 2**16 , ( 1024 , 1024 ) ).astype( np.uint16 )
+image2 = np.random.randint( 0 , 2**16 , ( 1024 , 1024 ) ).astype( np.uint16 )
+nmi_dense = calc_nmi.computeNMI( image1.astype( np.float64 ) , image2.astype( np.float64 ) , 64 )
+nmi_sparse = calc_nmi.computeNMI( image1.astype( np.float64 ) , image2.astype( np.float64 ) , 65536 )
+print( 'NMI ( 64 bins ) = ' , nmi_dense , '   NMI ( 65536 bins ) = ' , nmi_sparse )
+assert nmi_dense < 0.01
+assert nmi_sparse < 1.0
+
+print( '\nTEST: NMI of 16-bit volumes in streaming, expected equal to the in-memory one\n' )
+volume1 = np.random.randint( 0 , 2**16 , ( 8 , 128 , 128 ) ).astype( np.uint16 )
+volume2 = ( volume1 // 2 + np.random.randint( 0 , 2**14 , volume1.shape ) ).astype( np.uint16 )
+nmi1 = calc_nmi.computeNMI_stream( volume1 , volume2 , 256 , nslices=2 )
+nmi2 = calc_nmi.computeNMI( volume1.astype( np.float64 ) , volume2.astype( np.float64 ) , 256 )
+print( 'NMI streaming = ' , nmi1 , '   NMI in memory = ' , nmi2 )
+assert np.abs( nmi1 - nmi2 ) < 1e-5